@@ -6,18 +6,48 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import http.server
 import itertools
+import json
 import logging
 import math
+import operator
 import os.path
-from dataclasses import dataclass, fields, replace
-from typing import Optional
+import platform
+import random
+import sys
+import threading
+import time
+import timeit
+import types
+from dataclasses import asdict, astuple, dataclass, fields, replace
+from collections.abc import Callable, Mapping
+from typing import Optional, TypedDict, get_args, get_type_hints
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 # Income tax law, section 47a(a)
 NATIONAL_INSURANCE_INDEPENDENT_WRITEOFF_RATE = 0.52
 
 
 def tax_steps(s, steps):
+    if isinstance(steps, TaxSteps):
+        return steps.tax(s)
     tax = 0
     last_step = 0
     for step, tax_rate in steps:
@@ -28,27 +58,354 @@ def tax_steps(s, steps):
     return tax
 
 
+class TaxSteps:
+    """Immutable tax_steps() bracket table of (ceiling, rate) pairs.
+
+    cumulative[i] is the total tax up to ceilings[i], which is math.inf for an
+    unbounded last bracket.
+    """
+
+    __slots__ = ("steps", "ceilings", "rates", "cumulative")
+
+    def __init__(self, steps):
+        self.steps = tuple((step, tax_rate) for step, tax_rate in steps)
+        self.ceilings = tuple(step for step, _ in self.steps)
+        self.rates = tuple(tax_rate for _, tax_rate in self.steps)
+        cumulative = []
+        tax = 0
+        last_step = 0
+        for step, tax_rate in self.steps:
+            if step == math.inf:
+                tax = math.inf
+            else:
+                # Same operations as tax_steps(step, steps)
+                tax += tax_rate * (step - last_step)
+            cumulative.append(tax)
+            last_step = step
+        self.cumulative = tuple(cumulative)
+
+    def tax(self, s):
+        """tax_steps(s, self) in O(log n), with bit-identical results"""
+        # Same operations as the loop in tax_steps(), for the same rounding
+        i = bisect.bisect_left(self.ceilings, s)
+        if i == len(self.steps):
+            return self.cumulative[-1]
+        if i == 0:
+            return 0 + self.rates[0] * (s - 0)
+        return self.cumulative[i - 1] + self.rates[i] * (s - self.ceilings[i - 1])
+
+    def tax_batch(self, s):
+        """Vectorized tax() over a numpy array"""
+        require_numpy("batch evaluation")
+        s = np.asarray(s, dtype=float)
+        i = np.searchsorted(self.ceilings, s, side="left")
+        bracket = np.minimum(i, len(self.steps) - 1)
+        last_step = np.asarray((0, *self.ceilings[:-1]))[bracket]
+        tax = np.asarray((0, *self.cumulative[:-1]))[bracket] + np.asarray(self.rates)[
+            bracket
+        ] * (s - last_step)
+        return np.where(i == len(self.steps), self.cumulative[-1], tax)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, i):
+        return self.steps[i]
+
+    def __repr__(self):
+        return f"TaxSteps({list(self.steps)!r})"
+
+
 def income_tax(s, pts, consts):
     return tax_steps(s, consts["INCOME_TAX_STEPS"]) - (
         consts["INCOME_TAX_POINT_WORTH"] * pts
     )
 
 
-def natins_independent(y, consts):
-    m, t1 = consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"][0]
-    _, t2 = consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"][1]
-    z = NATIONAL_INSURANCE_INDEPENDENT_WRITEOFF_RATE
-
-    # Voodoo magic
-    # https://www.btl.gov.il/Insurance/National%20Insurance/type_list/Self_Employed/Pages/hishov.dmey.bituach.aspx
-    x = y - m * z * t1
-    if x <= m:
-        return max(x, 0)
+def require_numpy(feature):
+    if np is None:
+        raise RuntimeError(f"{feature} requires numpy to be installed")
+
+
+class NatinsIndependentInverse:
+    """natins_independent() of a bracket table with any number of steps.
+
+    The salary for national insurance of an independent, s, is the income y
+    less a writeoff of the national insurance paid, which is never less than
+    that of the first ceiling c1: s = y - z * T(max(s, c1)), where T is the
+    table's tax_steps() (flat above a finite top ceiling). The right side is
+    increasing and piecewise-linear in s, so it is inverted once into ranges of
+    y with s = (y + offsets[i]) / divisors[i], and each query is a bisection.
+    """
+
+    __slots__ = ("bounds", "offsets", "divisors")
+
+    def __init__(self, steps):
+        z = NATIONAL_INSURANCE_INDEPENDENT_WRITEOFF_RATE
+        steps = TaxSteps(steps)
+        finite = [i for i, ceiling in enumerate(steps.ceilings) if ceiling < math.inf]
+        # Up to c1 the writeoff is that of c1
+        self.bounds = []
+        self.offsets = [-z * steps.cumulative[0]]
+        self.divisors = [1]
+        for i in finite:
+            ceiling = steps.ceilings[i]
+            self.bounds.append(ceiling + z * steps.cumulative[i])
+            if i + 1 < len(steps):
+                tax_rate = steps.rates[i + 1]
+                self.offsets.append(z * (tax_rate * ceiling - steps.cumulative[i]))
+                self.divisors.append(1 + z * tax_rate)
+            else:
+                # National insurance stops at the top ceiling
+                self.offsets.append(-z * steps.cumulative[i])
+                self.divisors.append(1)
+
+    def __call__(self, y):
+        i = bisect.bisect_right(self.bounds, y)
+        return max((y + self.offsets[i]) / self.divisors[i], 0)
+
+    def batch(self, y):
+        """Vectorized __call__ over a numpy array"""
+        require_numpy("batch evaluation")
+        y = np.asarray(y, dtype=float)
+        i = np.searchsorted(self.bounds, y, side="right")
+        return np.maximum(
+            (y + np.asarray(self.offsets)[i]) / np.asarray(self.divisors)[i], 0
+        )
+
+    def function(self):
+        """__call__ as a PiecewiseLinear"""
+        zero = -self.offsets[0] / self.divisors[0]
+        return PiecewiseLinear(
+            (zero, *self.bounds),
+            [0] + [self(y) for y in self.bounds],
+            [0] + [1 / divisor for divisor in self.divisors],
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _natins_independent_inverse(steps):
+    return NatinsIndependentInverse(steps)
+
+
+def natins_independent_inverse(steps):
+    """The NatinsIndependentInverse of steps, computed once per table"""
+    if isinstance(steps, TaxSteps):
+        steps = steps.steps
     else:
-        return (y + m * z * (t2 - t1)) / (1 + z * t2)
+        steps = tuple((step, tax_rate) for step, tax_rate in steps)
+    return _natins_independent_inverse(steps)
 
 
-@dataclass
+def natins_independent(y, consts):
+    return natins_independent_inverse(consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"])(y)
+
+
+def natins_independent_batch(y, consts):
+    return natins_independent_inverse(
+        consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"]
+    ).batch(y)
+
+
+class PiecewiseLinear:
+    """Continuous piecewise-linear function of a single variable.
+
+    ys[i] is the value at breakpoint xs[i]; slopes[0] applies left of xs[0],
+    slopes[i] between xs[i - 1] and xs[i], and slopes[-1] right of xs[-1].
+    """
+
+    __slots__ = ("xs", "ys", "slopes")
+
+    def __init__(self, xs, ys, slopes):
+        self.xs = tuple(xs)
+        self.ys = tuple(ys)
+        self.slopes = tuple(slopes)
+        assert len(self.xs) == len(self.ys) == len(self.slopes) - 1 > 0
+
+    @classmethod
+    def linear(cls, slope=1, intercept=0):
+        return cls((0,), (intercept,), (slope, slope))
+
+    @classmethod
+    def from_steps(cls, steps):
+        """The tax_steps() function of a bracket table"""
+        xs = [0]
+        ys = [0]
+        slopes = [steps[0][1]]
+        last_step = 0
+        for step, tax_rate in steps:
+            slopes.append(tax_rate)
+            if step == math.inf:
+                break
+            xs.append(step)
+            ys.append(ys[-1] + tax_rate * (step - last_step))
+            last_step = step
+        else:
+            slopes.append(0)
+        return cls(xs, ys, slopes)
+
+    @staticmethod
+    def _points(xs):
+        # Sorted, merging points that only differ by rounding errors
+        points = []
+        for x in sorted(xs):
+            if not points or not math.isclose(
+                x, points[-1], rel_tol=1e-12, abs_tol=1e-9
+            ):
+                points.append(x)
+        return points
+
+    def simplify(self):
+        """Drop breakpoints where the slope does not change"""
+        keep = [
+            i
+            for i in range(len(self.xs))
+            if not math.isclose(
+                self.slopes[i], self.slopes[i + 1], rel_tol=1e-12, abs_tol=1e-12
+            )
+        ] or [0]
+        return PiecewiseLinear(
+            [self.xs[i] for i in keep],
+            [self.ys[i] for i in keep],
+            [self.slopes[0]] + [self.slopes[i + 1] for i in keep],
+        )
+
+    def __call__(self, x):
+        i = bisect.bisect_right(self.xs, x)
+        if i == 0:
+            return self.ys[0] + self.slopes[0] * (x - self.xs[0])
+        return self.ys[i - 1] + self.slopes[i] * (x - self.xs[i - 1])
+
+    def batch(self, x):
+        """Vectorized __call__ over a numpy array"""
+        require_numpy("batch evaluation")
+        x = np.asarray(x, dtype=float)
+        xs = np.asarray(self.xs)
+        i = np.searchsorted(xs, x, side="right")
+        j = np.maximum(i - 1, 0)
+        return np.asarray(self.ys)[j] + np.asarray(self.slopes)[i] * (x - xs[j])
+
+    def inverse(self, y):
+        """The lowest x with self(x) == y, for a non-decreasing function"""
+        i = bisect.bisect_left(self.ys, y)
+        if i == 0:
+            x0, y0 = self.xs[0], self.ys[0]
+        else:
+            x0, y0 = self.xs[i - 1], self.ys[i - 1]
+        slope = self.slopes[i]
+        if y == y0:
+            return x0
+        if slope <= 0:
+            raise ValueError(f"{y} is out of range")
+        return x0 + (y - y0) / slope
+
+    def inverse_batch(self, y):
+        """Vectorized inverse() over a numpy array, nan where out of range"""
+        require_numpy("batch evaluation")
+        y = np.asarray(y, dtype=float)
+        xs = np.asarray(self.xs)
+        ys = np.asarray(self.ys)
+        i = np.searchsorted(ys, y, side="left")
+        j = np.maximum(i - 1, 0)
+        slope = np.asarray(self.slopes)[i]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = xs[j] + (y - ys[j]) / slope
+        x = np.where(slope > 0, x, np.nan)
+        return np.where(y == ys[j], xs[j], x)
+
+    def inverted(self):
+        """The inverse function of a strictly increasing function"""
+        if min(self.slopes) <= 0:
+            raise ValueError("function is not strictly increasing")
+        return PiecewiseLinear(self.ys, self.xs, [1 / s for s in self.slopes])
+
+    def slope(self, x):
+        """Slope to the right of x"""
+        return self.slopes[bisect.bisect_right(self.xs, x)]
+
+    def _segment_slopes(self, xs):
+        # Slopes of self between consecutive points of xs, a superset of self.xs
+        middles = [(a + b) / 2 for a, b in zip(xs, xs[1:])]
+        return [self.slopes[0]] + [self.slope(x) for x in middles] + [self.slopes[-1]]
+
+    def _combine(self, other, op):
+        if not isinstance(other, PiecewiseLinear):
+            return PiecewiseLinear(
+                self.xs,
+                [op(y, other) for y in self.ys],
+                [op(s, 0) for s in self.slopes],
+            )
+        xs = self._points(self.xs + other.xs)
+        return PiecewiseLinear(
+            xs,
+            [op(self(x), other(x)) for x in xs],
+            map(op, self._segment_slopes(xs), other._segment_slopes(xs)),
+        ).simplify()
+
+    def __add__(self, other):
+        return self._combine(other, lambda a, b: a + b)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a - b)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __neg__(self):
+        return self * -1
+
+    def __mul__(self, factor):
+        return PiecewiseLinear(
+            self.xs, [y * factor for y in self.ys], [s * factor for s in self.slopes]
+        )
+
+    __rmul__ = __mul__
+
+    def compose(self, inner):
+        """The function self(inner(x))"""
+        xs = set(inner.xs)
+        bounds = [-math.inf, *inner.xs, math.inf]
+        for i, slope in enumerate(inner.slopes):
+            if slope == 0:
+                continue
+            lo, hi = bounds[i], bounds[i + 1]
+            x0 = hi if i == 0 else lo
+            y0 = inner(x0)
+            for y in self.xs:
+                x = x0 + (y - y0) / slope
+                if lo < x < hi:
+                    xs.add(x)
+        xs = self._points(xs)
+        outer_xs = [xs[0] - 1, *((a + b) / 2 for a, b in zip(xs, xs[1:])), xs[-1] + 1]
+        return PiecewiseLinear(
+            xs,
+            [self(inner(x)) for x in xs],
+            [
+                self.slope(inner(x)) * slope
+                for x, slope in zip(outer_xs, inner._segment_slopes(xs))
+            ],
+        ).simplify()
+
+    def minimum(self, c):
+        return PiecewiseLinear((c,), (c,), (1, 0)).compose(self)
+
+    def maximum(self, c):
+        return PiecewiseLinear((c,), (c,), (0, 1)).compose(self)
+
+
+def natins_independent_function(consts):
+    """natins_independent() as a PiecewiseLinear"""
+    return natins_independent_inverse(
+        consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"]
+    ).function()
+
+
+@dataclass(slots=True)
 class Details:
     salary: float
     in_tax: float
@@ -66,170 +423,659 @@ class Details:
     natins_employer: Optional[float]
 
 
-@dataclass
+@dataclass(slots=True)
 class Result:
     details: Details
     tax_values: dict[str, float]
 
 
-def impl(social_salary, non_social_salary, params, consts) -> Result:
-    tax = dict()
-    salary = social_salary + non_social_salary
-    if params["independent_mode"]:
-        # Social paymens
-        salary_for_pens = min(social_salary, consts["PENSION_INDEPENDENT_MAX_SALARY"])
-        pens_a = consts["PENSION_INDEPENDENT_RATE_WRITEOFF"] * salary_for_pens
-        pens_b = (
-            consts["PENSION_INDEPENDENT_RATE_REIMBURSE"]
-            + consts["PENSION_INDEPENDENT_RATE_REIMBURSE_ACA"]
-        ) * salary_for_pens
-        pens = pens_a + pens_b
-        sfund = consts["STUDY_FUND_INDEPENDENT"] * min(
-            social_salary, consts["STUDY_FUND_INDEPENDENT_MAX_SALARY"]
-        )
-        pens_employer = None
-        sfund_employer = None
-        reparations = None
-
-        tax_worth_expenses = min(salary, params["tax_worth_expenses"])
-
-        # National insurance
-        salary_for_natins = natins_independent(
-            salary - tax_worth_expenses - pens_a - sfund, consts
-        )
-        prev_worth = params.get("experimental_injected_previous_btl_worth")
-        if prev_worth is not None:
-            salary_for_natins += prev_worth
-        natins_tax = tax_steps(
-            salary_for_natins, consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"]
-        )
-        if prev_worth is not None:
-            # Offset the fact that the prev worth was taxed as an employee but we calculated it as an independent
-            offset = tax_steps(
-                prev_worth, consts["NATIONAL_INSURANCE_STEPS"]
-            ) - tax_steps(prev_worth, consts["INDEPENDENT_NATIONAL_INSURANCE_STEPS"])
-            assert offset <= 0
-            natins_tax += offset
-        natins_employer = None
-        healthins_tax = tax_steps(salary_for_natins, consts["HEALTH_INSURANCE_STEPS"])
-        natins_writeoff = natins_tax * NATIONAL_INSURANCE_INDEPENDENT_WRITEOFF_RATE
-        if params.get("experimental_delay_natins_payment", False):
-            natins_writeoff = 0
-
-        # Income tax
-        tax["deduction tax_worth_expenses"] = tax_worth_expenses
-        tax["deduction pens_a"] = pens_a
-        tax["deduction sfund"] = sfund
-        tax["deduction natins_writeoff"] = natins_writeoff
-        salary_for_income = (
-            salary - tax_worth_expenses - pens_a - sfund - natins_writeoff
-        )
-        prev_worth = params.get("experimental_injected_previous_tax_worth")
-        if prev_worth is not None:
-            tax["worth prev_worth"] = prev_worth
-            salary_for_income += prev_worth
-        in_tax = income_tax(salary_for_income, params["tax_pts"], consts)
-        pens_b_re = consts["PENSION_REIMBURSE"] * pens_b
-        tax["reimburse pens_b_re"] = pens_b_re
-        in_tax -= pens_b_re
-
-        prev_45a = params.get("experimental_injected_45a_value")
-        if prev_45a is not None:
-            pension_re = consts["PENSION_REIMBURSE"] * min(
-                prev_45a, consts["PENSION_REIMBURSE_PAYMENTS_MAX"]
-            )
-            tax["reimburse prev_45a"] = pension_re
-            in_tax -= pension_re
+# impl() is a sequence of stages. Each stage reads earlier values (and params
+# and consts), and writes its own values and tax entries. What a stage reads
+# and writes is declared with @impl_stage, so that IncrementalImpl knows which
+# stages a change affects without tracking the lookups themselves.
+#
+# The same stages compute impl(), impl_batch() and compile_impl(), whose values
+# are numbers, numpy arrays or PiecewiseLinear functions. Whatever depends on
+# the type of the values goes through the ImplOps passed to every stage.
 
-    else:
-        tax_worth_features = params["ten_bis"] + params["goods"]
-        tax["worth tax_worth_features"] = tax_worth_features
-
-        # Social payments
-        salary_for_pens = social_salary
-        pens = params["PENSION_EMPLOYEE"] * salary_for_pens
-        pens_employer = params["PENSION_EMPLOYER"] * salary_for_pens
-        if pens_employer > consts["PENSION_EMPLOYER_TAX_EXEMPT_PAYMENTS_MAX"]:
-            # Zkifat Tagmulim
-            pens_employer_taxed = (
-                pens_employer - consts["PENSION_EMPLOYER_TAX_EXEMPT_PAYMENTS_MAX"]
-            )
-            tax["worth pens_employer_taxed"] = pens_employer_taxed
-            tax_worth_features += pens_employer_taxed
-        reparations = params["PENSION_REPARATIONS"] * salary_for_pens
-        if reparations > consts["PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX"]:
-            # Zkifat Pitzuiim
-            reparations_taxed = (
-                reparations - consts["PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX"]
-            )
-            tax["worth reparations_taxed"] = reparations_taxed
-            tax_worth_features += reparations_taxed
-        if (
-            social_salary > consts["STUDY_FUND_TAX_EXEMPT_MAX"]
-            and params["full_study_fund"]
-        ):
-            # Zkifat Hishtalmut
-            sfund_taxed = (
-                social_salary - consts["STUDY_FUND_TAX_EXEMPT_MAX"]
-            ) * consts["STUDY_FUND_EMPLOYER"]
-            tax_worth_features += sfund_taxed
-            tax["worth sfund_taxed"] = sfund_taxed
-            sfund_salary = social_salary
-        else:
-            sfund_salary = min(social_salary, consts["STUDY_FUND_TAX_EXEMPT_MAX"])
 
-        sfund = consts["STUDY_FUND_EMPLOYEE"] * sfund_salary
-        sfund_employer = consts["STUDY_FUND_EMPLOYER"] * sfund_salary
+@dataclass(frozen=True, slots=True)
+class ImplOps:
+    minimum: Callable
+    maximum: Callable
+    # select(condition, if_true, if_false), where condition is a param
+    select: Callable
+    # tax(steps, s), the tax_steps() of s by a TaxSteps table
+    tax: Callable
+    natins_independent: Callable
+    # Whether taxed worths are recorded in tax even where they are 0
+    record_zeros: bool
+
+
+def _select(condition, if_true, if_false):
+    return if_true if condition else if_false
+
+
+def _compiled_tax(steps, s):
+    return PiecewiseLinear.from_steps(steps).compose(s)
+
+
+def _compiled_natins_independent(y, consts):
+    return natins_independent_function(consts).compose(y)
+
+
+SCALAR_OPS = ImplOps(min, max, _select, TaxSteps.tax, natins_independent, False)
+BATCH_OPS = ImplOps(
+    lambda x, c: np.minimum(x, c),
+    lambda x, c: np.maximum(x, c),
+    lambda condition, if_true, if_false: np.where(condition, if_true, if_false),
+    TaxSteps.tax_batch,
+    natins_independent_batch,
+    True,
+)
+COMPILED_OPS = ImplOps(
+    PiecewiseLinear.minimum,
+    PiecewiseLinear.maximum,
+    _select,
+    _compiled_tax,
+    _compiled_natins_independent,
+    True,
+)
+
+
+@dataclass(frozen=True)
+class StageDependencies:
+    params: tuple
+    consts: tuple
+    reads: tuple
+    writes: tuple
+
+
+def impl_stage(params=(), consts=(), reads=(), writes=()):
+    """Declare what an impl() stage reads, and the values it always writes"""
+
+    def decorator(function):
+        function.dependencies = StageDependencies(params, consts, reads, writes)
+        return function
+
+    return decorator
 
-        # National Insurance
-        salary_for_natins = salary + tax_worth_features
-        natins_tax = tax_steps(salary_for_natins, consts["NATIONAL_INSURANCE_STEPS"])
-        healthins_tax = tax_steps(salary_for_natins, consts["HEALTH_INSURANCE_STEPS"])
-        natins_employer = tax_steps(
-            salary_for_natins, consts["EMPLOYER_NATIONAL_INSURANCE_STEPS"]
+
+@impl_stage(reads=("social_salary", "non_social_salary"), writes=("salary",))
+def impl_salary(values, tax, params, consts, ops):
+    values["salary"] = values["social_salary"] + values["non_social_salary"]
+
+
+@impl_stage(
+    consts=(
+        "PENSION_INDEPENDENT_MAX_SALARY",
+        "PENSION_INDEPENDENT_RATE_WRITEOFF",
+        "PENSION_INDEPENDENT_RATE_REIMBURSE",
+        "PENSION_INDEPENDENT_RATE_REIMBURSE_ACA",
+    ),
+    reads=("social_salary",),
+    writes=(
+        "salary_for_pens",
+        "pens_a",
+        "pens_b",
+        "pens",
+        "pens_employer",
+        "reparations",
+    ),
+)
+def impl_independent_pension(values, tax, params, consts, ops):
+    # Social paymens
+    salary_for_pens = ops.minimum(
+        values["social_salary"], consts.PENSION_INDEPENDENT_MAX_SALARY
+    )
+    pens_a = consts.PENSION_INDEPENDENT_RATE_WRITEOFF * salary_for_pens
+    pens_b = (
+        consts.PENSION_INDEPENDENT_RATE_REIMBURSE
+        + consts.PENSION_INDEPENDENT_RATE_REIMBURSE_ACA
+    ) * salary_for_pens
+    values["salary_for_pens"] = salary_for_pens
+    values["pens_a"] = pens_a
+    values["pens_b"] = pens_b
+    values["pens"] = pens_a + pens_b
+    values["pens_employer"] = None
+    values["reparations"] = None
+
+
+@impl_stage(
+    consts=("STUDY_FUND_INDEPENDENT", "STUDY_FUND_INDEPENDENT_MAX_SALARY"),
+    reads=("social_salary",),
+    writes=("sfund", "sfund_employer"),
+)
+def impl_independent_study_fund(values, tax, params, consts, ops):
+    values["sfund"] = consts.STUDY_FUND_INDEPENDENT * ops.minimum(
+        values["social_salary"], consts.STUDY_FUND_INDEPENDENT_MAX_SALARY
+    )
+    values["sfund_employer"] = None
+
+
+@impl_stage(
+    params=("tax_worth_expenses",), reads=("salary",), writes=("tax_worth_expenses",)
+)
+def impl_independent_expenses(values, tax, params, consts, ops):
+    values["tax_worth_expenses"] = ops.minimum(
+        values["salary"], params["tax_worth_expenses"]
+    )
+
+
+@impl_stage(
+    params=(
+        "experimental_injected_previous_btl_worth",
+        "experimental_delay_natins_payment",
+    ),
+    consts=("INDEPENDENT_NATIONAL_INSURANCE_STEPS", "NATIONAL_INSURANCE_STEPS"),
+    reads=("salary", "tax_worth_expenses", "pens_a", "sfund"),
+    writes=("salary_for_natins", "natins_tax", "natins_employer", "natins_writeoff"),
+)
+def impl_independent_national_insurance(values, tax, params, consts, ops):
+    salary_for_natins = ops.natins_independent(
+        values["salary"]
+        - values["tax_worth_expenses"]
+        - values["pens_a"]
+        - values["sfund"],
+        consts,
+    )
+    prev_worth = params.get("experimental_injected_previous_btl_worth")
+    if prev_worth is not None:
+        salary_for_natins += prev_worth
+    natins_tax = ops.tax(consts.INDEPENDENT_NATIONAL_INSURANCE_STEPS, salary_for_natins)
+    if prev_worth is not None:
+        # Offset the fact that the prev worth was taxed as an employee but we calculated it as an independent
+        offset = tax_steps(prev_worth, consts.NATIONAL_INSURANCE_STEPS) - tax_steps(
+            prev_worth, consts.INDEPENDENT_NATIONAL_INSURANCE_STEPS
         )
+        assert offset <= 0
+        natins_tax += offset
+    natins_writeoff = natins_tax * NATIONAL_INSURANCE_INDEPENDENT_WRITEOFF_RATE
+    if params.get("experimental_delay_natins_payment", False):
+        natins_writeoff = 0
+    values["salary_for_natins"] = salary_for_natins
+    values["natins_tax"] = natins_tax
+    values["natins_employer"] = None
+    values["natins_writeoff"] = natins_writeoff
+
+
+@impl_stage(
+    params=(
+        "tax_pts",
+        "experimental_injected_previous_tax_worth",
+        "experimental_injected_45a_value",
+    ),
+    consts=(
+        "INCOME_TAX_STEPS",
+        "INCOME_TAX_POINT_WORTH",
+        "PENSION_REIMBURSE",
+        "PENSION_REIMBURSE_PAYMENTS_MAX",
+    ),
+    reads=(
+        "salary",
+        "tax_worth_expenses",
+        "pens_a",
+        "pens_b",
+        "sfund",
+        "natins_writeoff",
+    ),
+    writes=("salary_for_income", "in_tax"),
+)
+def impl_independent_income_tax(values, tax, params, consts, ops):
+    tax_worth_expenses = values["tax_worth_expenses"]
+    pens_a = values["pens_a"]
+    sfund = values["sfund"]
+    natins_writeoff = values["natins_writeoff"]
+    tax["deduction tax_worth_expenses"] = tax_worth_expenses
+    tax["deduction pens_a"] = pens_a
+    tax["deduction sfund"] = sfund
+    tax["deduction natins_writeoff"] = natins_writeoff
+    salary_for_income = (
+        values["salary"] - tax_worth_expenses - pens_a - sfund - natins_writeoff
+    )
+    prev_worth = params.get("experimental_injected_previous_tax_worth")
+    if prev_worth is not None:
+        tax["worth prev_worth"] = prev_worth
+        salary_for_income += prev_worth
+    in_tax = (
+        ops.tax(consts.INCOME_TAX_STEPS, salary_for_income)
+        - consts.INCOME_TAX_POINT_WORTH * params["tax_pts"]
+    )
+    pens_b_re = consts.PENSION_REIMBURSE * values["pens_b"]
+    tax["reimburse pens_b_re"] = pens_b_re
+    in_tax -= pens_b_re
 
-        # Income Tax
-        salary_for_income = salary + tax_worth_features
-        in_tax = income_tax(salary_for_income, params["tax_pts"], consts)
-        pension_re = consts["PENSION_REIMBURSE"] * min(
-            pens, consts["PENSION_REIMBURSE_PAYMENTS_MAX"]
+    prev_45a = params.get("experimental_injected_45a_value")
+    if prev_45a is not None:
+        pension_re = consts.PENSION_REIMBURSE * min(
+            prev_45a, consts.PENSION_REIMBURSE_PAYMENTS_MAX
         )
-        tax["reimburse pension_re"] = pension_re
+        tax["reimburse prev_45a"] = pension_re
         in_tax -= pension_re
+    values["salary_for_income"] = salary_for_income
+    values["in_tax"] = in_tax
+
+
+@impl_stage(params=("ten_bis", "goods"), writes=("tax_worth_features",))
+def impl_employee_features(values, tax, params, consts, ops):
+    tax_worth_features = params["ten_bis"] + params["goods"]
+    tax["worth tax_worth_features"] = tax_worth_features
+    values["tax_worth_features"] = tax_worth_features
+
+
+@impl_stage(
+    params=("PENSION_EMPLOYEE", "PENSION_EMPLOYER", "PENSION_REPARATIONS"),
+    consts=(
+        "PENSION_EMPLOYER_TAX_EXEMPT_PAYMENTS_MAX",
+        "PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX",
+    ),
+    reads=("social_salary",),
+    writes=(
+        "salary_for_pens",
+        "pens",
+        "pens_employer",
+        "pens_employer_taxed",
+        "reparations",
+        "reparations_taxed",
+    ),
+)
+def impl_employee_pension(values, tax, params, consts, ops):
+    # Social payments
+    salary_for_pens = values["social_salary"]
+    pens_employer = params["PENSION_EMPLOYER"] * salary_for_pens
+    # Zkifat Tagmulim
+    pens_employer_taxed = ops.maximum(
+        pens_employer - consts.PENSION_EMPLOYER_TAX_EXEMPT_PAYMENTS_MAX, 0
+    )
+    if ops.record_zeros or pens_employer_taxed > 0:
+        tax["worth pens_employer_taxed"] = pens_employer_taxed
+    reparations = params["PENSION_REPARATIONS"] * salary_for_pens
+    # Zkifat Pitzuiim
+    reparations_taxed = ops.maximum(
+        reparations - consts.PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX, 0
+    )
+    if ops.record_zeros or reparations_taxed > 0:
+        tax["worth reparations_taxed"] = reparations_taxed
+    values["salary_for_pens"] = salary_for_pens
+    values["pens"] = params["PENSION_EMPLOYEE"] * salary_for_pens
+    values["pens_employer"] = pens_employer
+    values["pens_employer_taxed"] = pens_employer_taxed
+    values["reparations"] = reparations
+    values["reparations_taxed"] = reparations_taxed
+
+
+@impl_stage(
+    params=("full_study_fund",),
+    consts=("STUDY_FUND_TAX_EXEMPT_MAX", "STUDY_FUND_EMPLOYEE", "STUDY_FUND_EMPLOYER"),
+    reads=("social_salary",),
+    writes=("sfund", "sfund_employer", "sfund_taxed"),
+)
+def impl_employee_study_fund(values, tax, params, consts, ops):
+    social_salary = values["social_salary"]
+    full_study_fund = params["full_study_fund"]
+    # Zkifat Hishtalmut
+    sfund_taxed = ops.select(
+        full_study_fund,
+        ops.maximum(social_salary - consts.STUDY_FUND_TAX_EXEMPT_MAX, 0)
+        * consts.STUDY_FUND_EMPLOYER,
+        0,
+    )
+    if ops.record_zeros or sfund_taxed > 0:
+        tax["worth sfund_taxed"] = sfund_taxed
+    sfund_salary = ops.select(
+        full_study_fund,
+        social_salary,
+        ops.minimum(social_salary, consts.STUDY_FUND_TAX_EXEMPT_MAX),
+    )
+    values["sfund"] = consts.STUDY_FUND_EMPLOYEE * sfund_salary
+    values["sfund_employer"] = consts.STUDY_FUND_EMPLOYER * sfund_salary
+    values["sfund_taxed"] = sfund_taxed
+
+
+@impl_stage(
+    reads=(
+        "salary",
+        "tax_worth_features",
+        "pens_employer_taxed",
+        "reparations_taxed",
+        "sfund_taxed",
+    ),
+    writes=("salary_for_natins", "salary_for_income"),
+)
+def impl_employee_taxable_salary(values, tax, params, consts, ops):
+    tax_worth_features = (
+        values["tax_worth_features"]
+        + values["pens_employer_taxed"]
+        + values["reparations_taxed"]
+        + values["sfund_taxed"]
+    )
+    values["salary_for_natins"] = values["salary"] + tax_worth_features
+    values["salary_for_income"] = values["salary"] + tax_worth_features
+
+
+@impl_stage(
+    consts=("NATIONAL_INSURANCE_STEPS", "EMPLOYER_NATIONAL_INSURANCE_STEPS"),
+    reads=("salary_for_natins",),
+    writes=("natins_tax", "natins_employer"),
+)
+def impl_employee_national_insurance(values, tax, params, consts, ops):
+    salary_for_natins = values["salary_for_natins"]
+    values["natins_tax"] = ops.tax(consts.NATIONAL_INSURANCE_STEPS, salary_for_natins)
+    values["natins_employer"] = ops.tax(
+        consts.EMPLOYER_NATIONAL_INSURANCE_STEPS, salary_for_natins
+    )
+
+
+@impl_stage(
+    consts=("HEALTH_INSURANCE_STEPS",),
+    reads=("salary_for_natins",),
+    writes=("healthins_tax",),
+)
+def impl_health_insurance(values, tax, params, consts, ops):
+    values["healthins_tax"] = ops.tax(
+        consts.HEALTH_INSURANCE_STEPS, values["salary_for_natins"]
+    )
+
+
+@impl_stage(
+    params=("tax_pts",),
+    consts=(
+        "INCOME_TAX_STEPS",
+        "INCOME_TAX_POINT_WORTH",
+        "PENSION_REIMBURSE",
+        "PENSION_REIMBURSE_PAYMENTS_MAX",
+    ),
+    reads=("salary_for_income", "pens"),
+    writes=("in_tax",),
+)
+def impl_employee_income_tax(values, tax, params, consts, ops):
+    in_tax = (
+        ops.tax(consts.INCOME_TAX_STEPS, values["salary_for_income"])
+        - consts.INCOME_TAX_POINT_WORTH * params["tax_pts"]
+    )
+    pension_re = consts.PENSION_REIMBURSE * ops.minimum(
+        values["pens"], consts.PENSION_REIMBURSE_PAYMENTS_MAX
+    )
+    tax["reimburse pension_re"] = pension_re
+    values["in_tax"] = in_tax - pension_re
 
-    netto_salary = salary - max(in_tax, 0) - natins_tax - healthins_tax - pens - sfund
+
+@impl_stage(
+    params=("experimental_injected_net_income",),
+    reads=("salary", "in_tax", "natins_tax", "healthins_tax", "pens", "sfund"),
+    writes=("netto_salary",),
+)
+def impl_netto_salary(values, tax, params, consts, ops):
+    netto_salary = (
+        values["salary"]
+        - ops.maximum(values["in_tax"], 0)
+        - values["natins_tax"]
+        - values["healthins_tax"]
+        - values["pens"]
+        - values["sfund"]
+    )
     prev_income = params.get("experimental_injected_net_income")
     if prev_income is not None:
         netto_salary += prev_income
-    details = Details(
-        salary,
-        in_tax,
-        natins_tax,
-        healthins_tax,
-        pens,
-        pens_employer,
-        reparations,
-        sfund,
-        sfund_employer,
-        salary_for_income,
-        salary_for_natins,
-        salary_for_pens,
-        netto_salary,
-        natins_employer,
-    )
-    return Result(details, tax)
+    values["netto_salary"] = netto_salary
+
+
+EMPLOYEE_IMPL_STAGES = (
+    impl_salary,
+    impl_employee_features,
+    impl_employee_pension,
+    impl_employee_study_fund,
+    impl_employee_taxable_salary,
+    impl_employee_national_insurance,
+    impl_health_insurance,
+    impl_employee_income_tax,
+    impl_netto_salary,
+)
+INDEPENDENT_IMPL_STAGES = (
+    impl_salary,
+    impl_independent_pension,
+    impl_independent_study_fund,
+    impl_independent_expenses,
+    impl_independent_national_insurance,
+    impl_health_insurance,
+    impl_independent_income_tax,
+    impl_netto_salary,
+)
+
+
+def impl_stages(params):
+    if params["independent_mode"]:
+        return INDEPENDENT_IMPL_STAGES
+    return EMPLOYEE_IMPL_STAGES
+
+
+_details_values = operator.itemgetter(*(field.name for field in fields(Details)))
+_details_attributes = operator.attrgetter(*(field.name for field in fields(Details)))
+
+
+def impl_result(values, tax) -> Result:
+    return Result(Details(*_details_values(values)), tax)
+
+
+def impl(social_salary, non_social_salary, params, consts) -> Result:
+    if not isinstance(consts, Constants):
+        consts = Constants(None, None, consts)
+    values = {"social_salary": social_salary, "non_social_salary": non_social_salary}
+    tax = dict()
+    for stage in impl_stages(params):
+        stage(values, tax, params, consts, SCALAR_OPS)
+    return impl_result(values, tax)
+
+
+@dataclass(frozen=True)
+class _StagePlans:
+    """The stages to rerun on a change, by the param, const or input changed"""
+
+    params: dict
+    consts: dict
+    inputs: dict
+
+
+@functools.lru_cache(maxsize=None)
+def _stage_plans(stages):
+    readers = ({}, {}, {})
+    for i, stage in enumerate(stages):
+        dependencies = stage.dependencies
+        for keys, index in zip(
+            (dependencies.params, dependencies.consts, dependencies.reads), readers
+        ):
+            for key in keys:
+                index.setdefault(key, set()).add(i)
+    # Stages read earlier values only, so each stage's closure extends those
+    # of the stages after it
+    closures = [None] * len(stages)
+    for i in reversed(range(len(stages))):
+        closure = {i}
+        for key in stages[i].dependencies.writes:
+            for j in readers[2].get(key, ()):
+                closure |= closures[j]
+        closures[i] = closure
+
+    def plans(index):
+        return {
+            key: tuple(sorted(set().union(*(closures[i] for i in indices))))
+            for key, indices in index.items()
+        }
+
+    return _StagePlans(*(plans(index) for index in readers))
+
+
+class IncrementalImpl:
+    """impl() that re-evaluates only what a change affects.
+
+    update() reruns the stages which read a changed param, const or input, as
+    declared with @impl_stage, and the stages which depend on their values.
+    """
+
+    def __init__(self, social_salary, non_social_salary, params, consts):
+        self.inputs = {
+            "social_salary": social_salary,
+            "non_social_salary": non_social_salary,
+        }
+        self.params = dict(params)
+        if not isinstance(consts, Constants):
+            consts = Constants(None, None, consts)
+        self.consts = consts
+        self.stages_run = 0
+        self._evaluate()
+
+    def _evaluate(self):
+        self.values = dict(self.inputs)
+        self._stages = impl_stages(self.params)
+        self._plans = _stage_plans(self._stages)
+        self._taxes = [None] * len(self._stages)
+        return self._rerun(range(len(self._stages)))
+
+    def _rerun(self, plan):
+        values = self.values
+        params = self.params
+        consts = self.consts
+        stages = self._stages
+        taxes = self._taxes
+        tax_changed = False
+        for i in plan:
+            stage_tax = dict()
+            stages[i](values, stage_tax, params, consts, SCALAR_OPS)
+            if stage_tax != taxes[i]:
+                taxes[i] = stage_tax
+                tax_changed = True
+        self.stages_run += len(plan)
+        if tax_changed:
+            tax = dict()
+            for stage_tax in taxes:
+                tax.update(stage_tax)
+        else:
+            tax = self.result.tax_values
+        self.result = impl_result(values, tax)
+        return self.result
+
+    def update(
+        self, social_salary=None, non_social_salary=None, consts=None, **params
+    ) -> Result:
+        """Change some of the inputs, params or consts and return the new Result"""
+        if consts is not None and not isinstance(consts, Constants):
+            consts = Constants(None, None, consts)
+        plans = []
+        for key, value in (
+            ("social_salary", social_salary),
+            ("non_social_salary", non_social_salary),
+        ):
+            if value is not None and value != self.inputs[key]:
+                self.inputs[key] = self.values[key] = value
+                plans.append(self._plans.inputs[key])
+        own_params = self.params
+        for key, value in params.items():
+            if key not in own_params or own_params[key] != value:
+                if key == "independent_mode":
+                    own_params.update(params)
+                    if consts is not None:
+                        self.consts = consts
+                    return self._evaluate()
+                if key in self._plans.params:
+                    plans.append(self._plans.params[key])
+        own_params.update(params)
+        if consts is not None and consts is not self.consts:
+            missing = object()
+            for key in set(consts) | set(self.consts):
+                if consts.get(key, missing) != self.consts.get(key, missing):
+                    if key in self._plans.consts:
+                        plans.append(self._plans.consts[key])
+            self.consts = consts
+        if not plans:
+            return self.result
+        if len(plans) == 1:
+            return self._rerun(plans[0])
+        return self._rerun(sorted(set().union(*plans)))
+
+
+def impl_batch(social_salary, non_social_salary, params, consts) -> Result:
+    """Vectorized impl().
+
+    Salaries (and any numeric param) may be numpy arrays, which are broadcast
+    together. Returns a Result whose fields are arrays (or None, as in impl()).
+    """
+    require_numpy("batch evaluation")
+    if not isinstance(consts, Constants):
+        consts = Constants(None, None, consts)
+    values = {
+        "social_salary": np.asarray(social_salary, dtype=float),
+        "non_social_salary": non_social_salary,
+    }
+    tax = dict()
+    for stage in impl_stages(params):
+        stage(values, tax, params, consts, BATCH_OPS)
+    return impl_result(values, tax)
+
+
+def compile_impl(social_salary, non_social_salary, params, consts) -> Details:
+    """impl() over PiecewiseLinear salaries.
+
+    social_salary is a PiecewiseLinear function of some variable, and
+    non_social_salary is either a number or another such function. Every
+    Details field is then a PiecewiseLinear of that variable (or None, as in
+    impl()), whose breakpoints are exactly where that quantity changes its rate.
+    """
+    if not isinstance(consts, Constants):
+        consts = Constants(None, None, consts)
+    values = {"social_salary": social_salary, "non_social_salary": non_social_salary}
+    tax = dict()
+    for stage in impl_stages(params):
+        stage(values, tax, params, consts, COMPILED_OPS)
+    return Details(*_details_values(values))
+
+
+def salary_split(params, ops=SCALAR_OPS):
+    """Split the salary in params into social and non-social parts.
+
+    Like the impl() stages, params may also hold numpy arrays or PiecewiseLinear
+    functions, given the matching ops.
+    """
+    if params["independent_mode"]:
+        social_salary = ops.maximum(
+            params["base_salary"] - params["tax_worth_expenses"], 0
+        )
+        non_social_salary = ops.minimum(
+            params["base_salary"], params["tax_worth_expenses"]
+        )
+    else:
+        social_salary = params["base_salary"] * params["percentage"]
+        non_social_salary = params["travel_allowance"] + params["bonuses"]
+    return social_salary, non_social_salary
+
+
+def compile_salary(params, consts) -> Details:
+    """compile_impl() as functions of base_salary, all other params fixed.
+
+    The netto_salary field is then a sorted breakpoint/slope table of net
+    salary by gross, which evaluates with a single bisection.
+    """
+    social_salary, non_social_salary = salary_split(
+        dict(params, base_salary=PiecewiseLinear.linear()), COMPILED_OPS
+    )
+    return compile_impl(social_salary, non_social_salary, params, consts)
 
 
 def result_filter(params, result: Result) -> Result:
-    details = result.details
-    for field in fields(details):
-        value = getattr(details, field.name)
-        if value is None:
-            continue
-        if params["annual_numbers"]:
-            value *= 12
-        details = replace(details, **{field.name: round(value)})
+    """Round (and annualize) result in a single pass"""
+    if params["annual_numbers"]:
+        values = [
+            None if value is None else round(value * 12)
+            for value in _details_attributes(result.details)
+        ]
+        tax_values = {k: v * 12 for k, v in result.tax_values.items()}
+    else:
+        values = [
+            None if value is None else round(value)
+            for value in _details_attributes(result.details)
+        ]
+        # Never modified, so shared with result
+        tax_values = result.tax_values
+    details = Details(*values)
 
     if details.in_tax < 0:
         logging.getLogger().warning(
@@ -237,9 +1083,57 @@ def result_filter(params, result: Result) -> Result:
         )
         details.in_tax = 0
 
-    tax_values = dict(result.tax_values)
-    if params["annual_numbers"]:
-        tax_values = {k: v * 12 for k, v in tax_values.items()}
+    return Result(details, tax_values)
+
+
+def result_filter_batch(params, result: Result) -> Result:
+    """result_filter() of an impl_batch() result, in place.
+
+    The float arrays of result are rounded (and annualized) where they are,
+    once even where fields share one, so no memory is allocated per row however
+    large the batch is. Other fields are replaced by rounded arrays.
+    """
+    require_numpy("batch evaluation")
+    scale = 12 if params["annual_numbers"] else 1
+
+    def in_place(value):
+        return (
+            isinstance(value, np.ndarray)
+            and value.dtype.kind == "f"
+            and value.flags.writeable
+        )
+
+    details = _details_attributes(result.details)
+    shared = {id(value) for value in details}
+    tax_values = result.tax_values
+    scaled = set()
+    for key, value in tax_values.items():
+        if id(value) in shared or not in_place(value):
+            # Not rounded, unlike the details
+            tax_values[key] = value * scale
+        elif id(value) not in scaled:
+            scaled.add(id(value))
+            if scale != 1:
+                np.multiply(value, scale, out=value)
+    rounded = {}
+    for value in details:
+        if value is None or id(value) in rounded:
+            continue
+        if in_place(value):
+            if scale != 1:
+                np.multiply(value, scale, out=value)
+            rounded[id(value)] = np.round(value, out=value)
+        else:
+            rounded[id(value)] = np.round(np.multiply(value, scale))
+    details = Details(
+        *(None if value is None else rounded[id(value)] for value in details)
+    )
+    wasted = np.count_nonzero(details.in_tax < 0)
+    if wasted:
+        logging.getLogger().warning(
+            f"got negative income tax in {wasted} results, whose tax benefits are wasted"
+        )
+        details.in_tax = np.maximum(details.in_tax, 0)
     return Result(details, tax_values)
 
 
@@ -263,7 +1157,7 @@ def params_filter(params):
     return params
 
 
-@dataclass
+@dataclass(slots=True)
 class RatesResult:
     income_rate: float
     natins_rate: float
@@ -302,112 +1196,2336 @@ def calculate_effective_marginal_rate(
     return RatesResult(income_rate, natins_rate, healthins_rate, total_rate)
 
 
-def main():
-    # Loading config
-    parser = argparse.ArgumentParser()
-    parser.add_argument("config", type=str, help="config to be used")
-    parser.add_argument("-v", "--verbose", action="store_true", help="extra logs")
-    parser.add_argument("-s", "--steps", action="store_true", help="extra logs")
-    args = parser.parse_args()
+def calculate_effective_marginal_rate_batch(
+    base, result1: Result, result2: Result
+) -> RatesResult:
+    """Vectorized calculate_effective_marginal_rate() for impl_batch() results"""
+    details1 = result1.details
+    details2 = result2.details
+    if details1.pens_employer is not None:
+        base = base + (
+            (details2.pens_employer - details1.pens_employer)
+            + (details2.sfund_employer - details1.sfund_employer)
+            + (details2.reparations - details1.reparations)
+        )
+    income_rate = np.where(
+        details1.in_tax <= 0, 0, (details2.in_tax - details1.in_tax) / base
+    )
+    natins_rate = (details2.natins_tax - details1.natins_tax) / base
+    healthins_rate = (details2.healthins_tax - details1.healthins_tax) / base
+    total_rate = income_rate + natins_rate + healthins_rate
+    return RatesResult(income_rate, natins_rate, healthins_rate, total_rate)
 
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
-    log = logging.getLogger()
 
-    with open(f"{args.config}", "r", encoding="utf-8") as f:
-        params = {}
-        exec(f.read(), params)
+class Dual:
+    """Forward-mode dual number, value + derivative * eps.
 
-    try:
-        with open(
-            os.path.join(
-                os.path.abspath(os.path.dirname(__file__)),
-                "constants",
-                f"{params['TAX_YEAR']}.py",
-            ),
-            "r",
-            encoding="utf-8",
-        ) as f:
-            consts = {}
-            exec(f.read(), consts)
-    except FileNotFoundError:
-        log.error(f"Tax calculations for {params['TAX_YEAR']} not supported")
-        return
+    Comparisons are lexicographic on (value, derivative), so at a kink every
+    min(), max() and bracket lookup follows the side the derivative points to,
+    and the derivative that comes out is the one-sided slope on that side.
+    """
 
-    params = params_filter(params)
+    __slots__ = ("value", "derivative")
 
-    if args.steps:
-        print("---Tax steps analysis---")
-        last_step = [
-            ceiling for ceiling, _ in consts["INCOME_TAX_STEPS"] if ceiling < math.inf
-        ][-1]
-        last_rate = None
-        last_rate_floor = 0
-        params_clean = dict(params)
-        params_clean.update(tax_worth_expenses=0, ten_bis=0, goods=0)
-        output_filter = (
-            (lambda x: round(x * 12))
-            if params["annual_numbers"]
-            else (lambda x: round(x))
-        )
-        for income in range(int(last_step) * 12 * 2):
-            income /= 12
-            result1 = impl(income, 0, params_clean, consts)
-            result2 = impl(income + 1 / 12, 0, params_clean, consts)
-            effrate = calculate_effective_marginal_rate(1 / 12, result1, result2)
-            if args.verbose:
-                for result in (result1, result2):
-                    log_tax = logging.getLogger("taxes")
-                    result_pretty = result_filter(params, result)
-                    for k, v in result_pretty.tax_values.items():
-                        log_tax.debug(f"{k}={v}")
-
-            if last_rate is None:
-                last_rate = effrate
-                last_rate_floor = income
-            elif (
-                abs(effrate.total_rate - last_rate.total_rate) >= 0.005
-                and income - last_rate_floor > 10
-            ):
-                print(
-                    f"{output_filter(last_rate_floor)} - {output_filter(income)}: {last_rate.total_rate:.2f} ({last_rate.income_rate:.2f}, {last_rate.natins_rate:.2f}, {last_rate.healthins_rate:.2f})"
-                )
-                last_rate_floor = income
-            last_rate = effrate
-        assert last_rate is not None
-        print(
-            f"{output_filter(last_rate_floor)} - infinity: {last_rate.total_rate:.2f} ({last_rate.income_rate:.2f}, {last_rate.natins_rate:.2f}, {last_rate.healthins_rate:.2f})"
-        )
-        return
+    def __init__(self, value, derivative=0):
+        self.value = value
+        self.derivative = derivative
 
-    if params["independent_mode"]:
-        if params["tax_worth_expenses"] > params["base_salary"]:
-            social_salary = 0
-            non_social_salary = params["base_salary"]
-        else:
-            social_salary = params["base_salary"] - params["tax_worth_expenses"]
-            non_social_salary = params["tax_worth_expenses"]
-    else:
-        social_salary = params["base_salary"] * params["percentage"]
-        non_social_salary = params["travel_allowance"] + params["bonuses"]
+    @staticmethod
+    def split(x):
+        if isinstance(x, Dual):
+            return x.value, x.derivative
+        return x, 0
 
-    result = impl(social_salary, non_social_salary, params, consts)
+    def __add__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value + other.value, self.derivative + other.derivative)
+        return Dual(self.value + other, self.derivative)
 
-    rate = [
-        rate
-        for ceiling, rate in consts["INCOME_TAX_STEPS"]
-        if result.details.salary_for_income < ceiling
-    ][0]
-    result2 = impl(social_salary + 1, non_social_salary, params, consts)
-    effrate = calculate_effective_marginal_rate(1, result, result2)
-    effrate_text = (
-        f"; effective marginal rate {effrate.income_rate:.2f}"
-        if abs(rate - effrate.income_rate) >= 0.01
-        else ""
-    )
+    __radd__ = __add__
 
-    result_pretty = result_filter(params, result)
-    log_tax = logging.getLogger("taxes")
+    def __sub__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value - other.value, self.derivative - other.derivative)
+        return Dual(self.value - other, self.derivative)
+
+    def __rsub__(self, other):
+        return Dual(other - self.value, -self.derivative)
+
+    def __neg__(self):
+        return Dual(-self.value, -self.derivative)
+
+    def __mul__(self, other):
+        if isinstance(other, Dual):
+            return Dual(
+                self.value * other.value,
+                self.derivative * other.value + self.value * other.derivative,
+            )
+        return Dual(self.value * other, self.derivative * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Dual):
+            return Dual(
+                self.value / other.value,
+                (self.derivative * other.value - self.value * other.derivative)
+                / other.value**2,
+            )
+        return Dual(self.value / other, self.derivative / other)
+
+    def __rtruediv__(self, other):
+        return Dual(other) / self
+
+    def _compare(self, other):
+        # Sign of (self - other) in the lexicographic order
+        value, derivative = Dual.split(other)
+        if self.value != value:
+            return -1 if self.value < value else 1
+        if self.derivative != derivative:
+            return -1 if self.derivative < derivative else 1
+        return 0
+
+    def __eq__(self, other):
+        return self._compare(other) == 0
+
+    def __lt__(self, other):
+        return self._compare(other) < 0
+
+    def __le__(self, other):
+        return self._compare(other) <= 0
+
+    def __gt__(self, other):
+        return self._compare(other) > 0
+
+    def __ge__(self, other):
+        return self._compare(other) >= 0
+
+    __hash__ = None
+
+    def __float__(self):
+        return float(self.value)
+
+    def __round__(self, ndigits=None):
+        return round(self.value, ndigits)
+
+    def __repr__(self):
+        return f"Dual({self.value!r}, {self.derivative!r})"
+
+
+def calculate_marginal_rates(
+    social_salary, non_social_salary, params, consts, side=1
+) -> tuple[Result, RatesResult]:
+    """Exact effective marginal rates of the social salary, from a single impl().
+
+    impl() runs on a Dual social salary; side is 1 for the rates right of
+    social_salary and -1 for the rates left of it, which differ at kinks.
+    Returns the plain impl() result and the rates, defined as in
+    calculate_effective_marginal_rate().
+    """
+    result = impl(Dual(social_salary, side), non_social_salary, params, consts)
+    details = result.details
+
+    def slope(x):
+        return side * x.derivative if isinstance(x, Dual) else 0
+
+    base = 1
+    if details.pens_employer is not None:
+        base += (
+            slope(details.pens_employer)
+            + slope(details.sfund_employer)
+            + slope(details.reparations)
+        )
+    if details.in_tax <= 0:
+        income_rate = 0
+    else:
+        income_rate = slope(details.in_tax) / base
+    natins_rate = slope(details.natins_tax) / base
+    healthins_rate = slope(details.healthins_tax) / base
+    total_rate = income_rate + natins_rate + healthins_rate
+    values = [Dual.split(value)[0] for value in _details_attributes(details)]
+    tax_values = {k: Dual.split(v)[0] for k, v in result.tax_values.items()}
+    return (
+        Result(Details(*values), tax_values),
+        RatesResult(income_rate, natins_rate, healthins_rate, total_rate),
+    )
+
+
+_worker_state = {}
+
+
+def picklable_params(params):
+    """params without the modules and functions a config may define"""
+    return {
+        k: v
+        for k, v in params.items()
+        if not k.startswith("__")
+        and not callable(v)
+        and not isinstance(v, types.ModuleType)
+    }
+
+
+def parallel_map(function, iterable, jobs, initializer=None, initargs=()):
+    """Ordered map of function over a process pool.
+
+    Unlike Executor.map(), only a bounded number of items of iterable are
+    consumed ahead of the results, so it can stream arbitrarily long inputs.
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def steps_params(params):
+    params_clean = dict(params)
+    params_clean.update(tax_worth_expenses=0, ten_bis=0, goods=0)
+    return params_clean
+
+
+def steps_sweep_end(consts):
+    last_step = [
+        ceiling for ceiling, _ in consts["INCOME_TAX_STEPS"] if ceiling < math.inf
+    ][-1]
+    return int(last_step) * 12 * 2
+
+
+def scan_rate_changes(params, consts, start, stop, verbose=False):
+    """Sweep salaries i / 12 for i in [start, stop) for marginal rate changes.
+
+    Returns the (i, rate right below i) pairs where the total rate changes by
+    at least 0.005, and the rate at the end of the range.
+    """
+    changes = []
+    last_rate = None
+    for income in range(max(start - 1, 0), stop):
+        i = income
+        income /= 12
+        result1 = impl(income, 0, params, consts)
+        result2 = impl(income + 1 / 12, 0, params, consts)
+        effrate = calculate_effective_marginal_rate(1 / 12, result1, result2)
+        if verbose:
+            for result in (result1, result2):
+                log_tax = logging.getLogger("taxes")
+                result_pretty = result_filter(params, result)
+                for k, v in result_pretty.tax_values.items():
+                    log_tax.debug(f"{k}={v}")
+
+        if (
+            last_rate is not None
+            and abs(effrate.total_rate - last_rate.total_rate) >= 0.005
+        ):
+            changes.append((i, last_rate))
+        last_rate = effrate
+    return changes, last_rate
+
+
+def merge_rate_changes(changes, last_rate):
+    """Turn scan_rate_changes() results into (floor, rates) segments"""
+    segments = []
+    last_rate_floor = 0
+    for i, rate in changes:
+        income = i / 12
+        if income - last_rate_floor > 10:
+            segments.append((last_rate_floor, rate))
+            last_rate_floor = income
+    assert last_rate is not None
+    segments.append((last_rate_floor, last_rate))
+    return segments
+
+
+def _init_steps_worker(params):
+    _worker_state["params"] = params
+    _worker_state["consts"] = load_consts(params["TAX_YEAR"])
+
+
+def _scan_rate_changes_chunk(bounds):
+    return scan_rate_changes(_worker_state["params"], _worker_state["consts"], *bounds)
+
+
+def scan_rate_segments(params, consts, verbose=False, jobs=1):
+    """Sweep salaries in 1/12 increments, returning (floor, rates) segments"""
+    params_clean = steps_params(params)
+    count = steps_sweep_end(consts)
+    if jobs == 1 or verbose:
+        return merge_rate_changes(
+            *scan_rate_changes(params_clean, consts, 0, count, verbose)
+        )
+
+    chunk_size = -(-count // (jobs * 4))
+    changes = []
+    for chunk_changes, last_rate in parallel_map(
+        _scan_rate_changes_chunk,
+        (
+            (start, min(start + chunk_size, count))
+            for start in range(0, count, chunk_size)
+        ),
+        jobs,
+        _init_steps_worker,
+        (picklable_params(params_clean),),
+    ):
+        changes += chunk_changes
+    return merge_rate_changes(changes, last_rate)
+
+
+def scan_rate_segments_batch(params, consts, chunk_size=1 << 16):
+    """Vectorized scan_rate_segments()"""
+    require_numpy("batch evaluation")
+    params_clean = steps_params(params)
+    count = steps_sweep_end(consts)
+    chunks = []
+    for start in range(0, count, chunk_size):
+        incomes = np.arange(start, min(start + chunk_size, count)) / 12
+        result1 = impl_batch(incomes, 0, params_clean, consts)
+        result2 = impl_batch(incomes + 1 / 12, 0, params_clean, consts)
+        effrate = calculate_effective_marginal_rate_batch(1 / 12, result1, result2)
+        chunks.append(
+            (
+                effrate.income_rate,
+                effrate.natins_rate,
+                effrate.healthins_rate,
+                effrate.total_rate,
+            )
+        )
+    rates = [np.concatenate(column) for column in zip(*chunks)]
+
+    def rates_at(i):
+        return RatesResult(*(float(column[i]) for column in rates))
+
+    changes = np.flatnonzero(np.abs(np.diff(rates[3])) >= 0.005) + 1
+    return merge_rate_changes(
+        [(int(i), rates_at(i - 1)) for i in changes], rates_at(count - 1)
+    )
+
+
+def exact_rate_segments(params, consts):
+    """Same as scan_rate_segments(), derived from the breakpoints of compile_impl()"""
+    details = compile_impl(PiecewiseLinear.linear(), 0, steps_params(params), consts)
+    in_tax = details.in_tax.maximum(0)
+    employer = None
+    if details.pens_employer is not None:
+        employer = details.pens_employer + details.sfund_employer + details.reparations
+    functions = [
+        f
+        for f in (in_tax, details.natins_tax, details.healthins_tax, employer)
+        if f is not None
+    ]
+    floors = sorted({0} | {x for f in functions for x in f.xs if x > 0})
+    segments = []
+    for floor, ceiling in zip(floors, floors[1:] + [floors[-1] + 2]):
+        x = (floor + ceiling) / 2
+        base = 1 if employer is None else 1 + employer.slope(x)
+        # Adding 0.0 turns negative zeros from flat segments into zeros
+        income_rate = in_tax.slope(x) / base + 0.0
+        natins_rate = details.natins_tax.slope(x) / base + 0.0
+        healthins_rate = details.healthins_tax.slope(x) / base + 0.0
+        rate = RatesResult(
+            income_rate,
+            natins_rate,
+            healthins_rate,
+            income_rate + natins_rate + healthins_rate,
+        )
+        if segments and all(
+            math.isclose(a, b, abs_tol=1e-9)
+            for a, b in zip(astuple(rate), astuple(segments[-1][1]))
+        ):
+            continue
+        segments.append((floor, rate))
+    return segments
+
+
+def rate_segments(params, consts, exact=False, verbose=False, jobs=1):
+    """Rate segments with exact_rate_segments() or the fastest available scan"""
+    if exact:
+        return exact_rate_segments(params, consts)
+    if np is not None and not verbose:
+        return scan_rate_segments_batch(params, consts)
+    return scan_rate_segments(params, consts, verbose, jobs)
+
+
+STEPS_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "hasalary",
+    "steps",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _source_digest():
+    """Digest of this script, whose rules and file format the cache depends on"""
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def rate_segments_cache_path(directory, params, consts, exact=False):
+    """Cache file of the segments of params and Constants from load_consts().
+
+    Segments depend on the constants, the script computing them and on the
+    IMPL_PARAMS of steps_params() only; they are monthly whatever annual_numbers
+    is.
+    """
+    params_clean = steps_params(params)
+    key = json.dumps(
+        [
+            _source_digest(),
+            consts.digest,
+            "exact" if exact else "scan",
+            [params_clean.get(name) for name in IMPL_PARAMS],
+        ]
+    )
+    return os.path.join(
+        directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".bin"
+    )
+
+
+def read_rate_segments(path):
+    """Read segments stored as float64 records of floor and the RatesResult fields"""
+    record_size = 1 + len(fields(RatesResult))
+    records = array.array("d")
+    with open(path, "rb") as f:
+        records.frombytes(f.read())
+    if not records or len(records) % record_size:
+        raise ValueError(f"{path} is not a rate segments file")
+    return [
+        (records[i], RatesResult(*records[i + 1 : i + record_size]))
+        for i in range(0, len(records), record_size)
+    ]
+
+
+def write_rate_segments(path, segments):
+    records = array.array(
+        "d",
+        itertools.chain.from_iterable(
+            (floor, *astuple(rate)) for floor, rate in segments
+        ),
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and renamed, so concurrent runs never read a partial file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        records.tofile(f)
+    os.replace(temp_path, path)
+
+
+def cached_rate_segments(directory, params, consts, exact=False, jobs=1):
+    """rate_segments(), read from or else stored to the cache in directory"""
+    path = rate_segments_cache_path(directory, params, consts, exact)
+    try:
+        return read_rate_segments(path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.getLogger().warning(f"Ignoring steps cache {path}: {e}")
+    segments = rate_segments(params, consts, exact, jobs=jobs)
+    try:
+        write_rate_segments(path, segments)
+    except OSError as e:
+        logging.getLogger().warning(f"Cannot write steps cache: {e}")
+    return segments
+
+
+def print_rate_segments(params, segments):
+    output_filter = (
+        (lambda x: round(x * 12)) if params["annual_numbers"] else (lambda x: round(x))
+    )
+    ceilings = [floor for floor, _ in segments[1:]] + [None]
+    for (floor, rate), ceiling in zip(segments, ceilings):
+        ceiling_text = "infinity" if ceiling is None else output_filter(ceiling)
+        print(
+            f"{output_filter(floor)} - {ceiling_text}: {rate.total_rate:.2f} ({rate.income_rate:.2f}, {rate.natins_rate:.2f}, {rate.healthins_rate:.2f})"
+        )
+
+
+def print_net_table(params, consts):
+    netto_salary = compile_salary(params, consts).netto_salary
+    scale = 12 if params["annual_numbers"] else 1
+    for x in [0] + [x for x in netto_salary.xs if x > 0]:
+        print(
+            f"{round(x * scale)}: {round(netto_salary(x) * scale)} (+{netto_salary.slope(x):.2f})"
+        )
+
+
+def _minimum(x, c):
+    return x.minimum(c) if isinstance(x, PiecewiseLinear) else min(x, c)
+
+
+def _maximum(x, c):
+    return x.maximum(c) if isinstance(x, PiecewiseLinear) else max(x, c)
+
+
+@dataclass
+class Income:
+    reparations_cash: float
+    sfund_cash: float
+    pens_total: float
+    total_monthly_income: float
+
+
+def calculate_income(details: Details, params, consts) -> Income:
+    """Cash income including savings funds, before postprocess.
+
+    Works on both impl() and compile_impl() details.
+    """
+    if details.reparations is None:
+        reparations_cash = 0
+    else:
+        reparations_cash = _minimum(
+            details.reparations, consts["REPARATIONS_PULL_TAX_EXEMPT_MAX"]
+        ) + _maximum(
+            details.reparations - consts["PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX"],
+            0,
+        )
+        if params["include_pension"]:
+            reparations_cash = details.reparations
+        elif params["monthly_reparations_pull"]:
+            # Nothing is taxed below REPARATIONS_PULL_TAX_EXEMPT_MAX
+            taxed_reparations = details.reparations - reparations_cash
+            tax_rate = (
+                income_tax(
+                    params["monthly_reparations_pull"], params["tax_pts"], consts
+                )
+                / params["monthly_reparations_pull"]
+            )
+            reparations_cash += taxed_reparations * (1 - tax_rate)
+
+    sfund_cash = (
+        details.sfund
+        if details.sfund_employer is None
+        else details.sfund + details.sfund_employer
+    )
+    pens_total = (
+        details.pens
+        if details.pens_employer is None
+        else (details.pens + details.pens_employer)
+    )
+    total_monthly_income = details.netto_salary + reparations_cash + sfund_cash
+    if params["include_pension"]:
+        total_monthly_income += pens_total
+    return Income(reparations_cash, sfund_cash, pens_total, total_monthly_income)
+
+
+def employment_cost(details: Details, params):
+    """Employer cost of an employee, for impl() or compile_impl() details"""
+    return (
+        details.salary
+        + params["ten_bis"]
+        + params["goods"]
+        + details.natins_employer
+        + details.pens_employer
+        + details.reparations
+        + details.sfund_employer
+    )
+
+
+def savings_months(current_cash, monthly_gain, monthly_gain_rate, target):
+    """Months of saving until target is reached, or None if it never is.
+
+    After i months the savings are current_cash * r**i + monthly_gain * (1 + r
+    + ... + r**(i - 1)), which is solved for i in closed form.
+    """
+    r = monthly_gain_rate
+    if r <= 0:
+        raise ValueError("gain rate must be positive")
+
+    def savings(i):
+        if r == 1:
+            return current_cash + monthly_gain * i
+        return current_cash * r**i + monthly_gain * (r**i - 1) / (r - 1)
+
+    if current_cash >= target:
+        return 0
+    if r == 1:
+        if monthly_gain <= 0:
+            return None
+        i = math.ceil((target - current_cash) / monthly_gain)
+    else:
+        # savings(i) = (current_cash + a) * r**i - a
+        a = monthly_gain / (r - 1)
+        b = current_cash + a
+        if not (b > 0 and r > 1 or b < 0 and r < 1):
+            # Savings never grow
+            return None
+        q = (target + a) / b
+        if q <= 0:
+            # Savings converge to -a, which is below target
+            return None
+        i = max(math.ceil(math.log(q) / math.log(r)), 0)
+
+    # Correct rounding errors of the closed form
+    while i > 0 and savings(i - 1) >= target:
+        i -= 1
+    while savings(i) < target:
+        i += 1
+    return i
+
+
+def simulate_savings_months(
+    current_cash,
+    monthly_gain,
+    yearly_gain_rate,
+    yearly_gain_stddev,
+    target,
+    paths,
+    months,
+    seed=None,
+):
+    """Monte Carlo variant of savings_months().
+
+    Yearly log returns are normal around log(yearly_gain_rate) with the given
+    standard deviation. Returns the months to target of each path, inf for paths
+    which do not reach it within months.
+    """
+    require_numpy("savings simulation")
+    rng = np.random.default_rng(seed)
+    mu = math.log(yearly_gain_rate) / 12
+    sigma = yearly_gain_stddev / math.sqrt(12)
+    cash = np.full(paths, float(current_cash))
+    result = np.where(cash >= target, 0, np.inf)
+    for month in range(1, months + 1):
+        cash = cash * np.exp(rng.normal(mu, sigma, paths)) + monthly_gain
+        result[(cash >= target) & (result == np.inf)] = month
+    return result
+
+
+SOLVE_QUANTITIES = ("netto_salary", "total_monthly_income", "employment_cost")
+
+
+def solve_base_salary(target, params, consts, quantity="netto_salary"):
+    """The lowest base_salary for which quantity reaches target.
+
+    quantity is one of SOLVE_QUANTITIES, all of which are monotone
+    piecewise-linear in base_salary, so this is a bisection of the
+    compile_salary() breakpoints followed by one linear interpolation.
+    """
+    details = compile_salary(params, consts)
+    if quantity == "netto_salary":
+        function = details.netto_salary
+    elif quantity == "total_monthly_income":
+        function = calculate_income(details, params, consts).total_monthly_income
+    elif quantity == "employment_cost":
+        if params["independent_mode"]:
+            raise ValueError("employment cost is not defined for independents")
+        function = employment_cost(details, params)
+    else:
+        raise ValueError(f"unknown quantity {quantity!r}")
+    base_salary = function.inverse(target)
+    if base_salary < 0:
+        raise ValueError(f"{quantity} is above {target} even with no salary")
+    return base_salary
+
+
+OPTIMIZE_OBJECTIVES = ("total_monthly_income", "savings")
+
+
+def optimize_compensation(
+    budget, params, consts, objective="total_monthly_income", pension_rates=(0.06, 0.07)
+):
+    """The employee package with the best objective for an employment_cost() budget.
+
+    Chooses the split between base_salary and bonuses (travel_allowance is
+    kept), PENSION_EMPLOYEE within pension_rates and full_study_fund. ten_bis
+    and goods are kept as well, since neither objective counts them. objective
+    is total_monthly_income as configured, or savings which also counts all
+    pension and reparations money. Returns (params, objective value).
+
+    With K(x) = x + natins_employer(x) of salary_for_natins x, the budget is
+    K(x) + h(social_salary) where h is the employer contributions minus their
+    taxed part, so along the budget the non-social salary is piecewise-linear
+    in the social salary, and so is the objective. Its maximum is therefore at
+    a breakpoint, and only these are evaluated. The objective is monotone in
+    PENSION_EMPLOYEE: it falls with the rate when pension is not counted, and
+    never falls when it is, so only the ends of pension_rates are evaluated.
+    """
+    if params["independent_mode"]:
+        raise ValueError("employment cost is not defined for independents")
+    if objective not in OPTIMIZE_OBJECTIVES:
+        raise ValueError(f"unknown objective {objective!r}")
+    if params["percentage"] <= 0:
+        raise ValueError("percentage must be positive")
+    best = None
+    social_salary = PiecewiseLinear.linear()
+    employer_natins = PiecewiseLinear.linear() + PiecewiseLinear.from_steps(
+        consts["EMPLOYER_NATIONAL_INSURANCE_STEPS"]
+    )
+    for full_study_fund, pension_rate in itertools.product(
+        (False, True), pension_rates
+    ):
+        candidate = dict(
+            params, full_study_fund=full_study_fund, PENSION_EMPLOYEE=pension_rate
+        )
+        if objective == "savings":
+            candidate["include_pension"] = True
+        details = compile_impl(social_salary, 0, candidate, consts)
+        taxed = (
+            details.salary_for_natins
+            - details.salary
+            - (candidate["ten_bis"] + candidate["goods"])
+        )
+        employer = details.pens_employer + details.reparations + details.sfund_employer
+        salary_for_natins = employer_natins.inverted().compose(
+            budget - (employer - taxed)
+        )
+        non_social_salary = salary_for_natins - details.salary_for_natins
+        # non_social_salary decreases with the social salary
+        try:
+            max_social = (-non_social_salary).inverse(-candidate["travel_allowance"])
+        except ValueError:
+            continue
+        if max_social < 0:
+            continue
+        details = compile_impl(social_salary, non_social_salary, candidate, consts)
+        value = calculate_income(details, candidate, consts).total_monthly_income
+        for x in [0, *(x for x in value.xs if 0 < x < max_social), max_social]:
+            if best is None or value(x) > best[1]:
+                best = (
+                    dict(
+                        candidate,
+                        base_salary=x / candidate["percentage"],
+                        bonuses=non_social_salary(x) - candidate["travel_allowance"],
+                        include_pension=params["include_pension"],
+                    ),
+                    value(x),
+                )
+    if best is None:
+        raise ValueError(f"budget {budget} does not cover travel_allowance")
+    return best
+
+
+# Params which employment_cost() depends on, besides base_salary
+BUDGET_PARAMS = (
+    "percentage",
+    "travel_allowance",
+    "bonuses",
+    "ten_bis",
+    "goods",
+    "PENSION_EMPLOYER",
+    "PENSION_REPARATIONS",
+    "full_study_fund",
+)
+
+
+class BudgetSolver:
+    """The maximal base_salary for employment_cost() budgets.
+
+    employment_cost() is compiled into a breakpoint table once per constants
+    and distinct BUDGET_PARAMS, after which every budget is one bisection. The
+    maxsize most recently used tables are kept, so rows which each have their
+    own BUDGET_PARAMS do not grow it. Only Constants, as returned by
+    load_consts(), are cached by their digest.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._functions = collections.OrderedDict()
+
+    def function(self, params, consts):
+        if params["independent_mode"]:
+            raise ValueError("employment cost is not defined for independents")
+        if not isinstance(consts, Constants):
+            return employment_cost(compile_salary(params, consts), params)
+        key = (consts.digest, tuple(params[name] for name in BUDGET_PARAMS))
+        function = self._functions.get(key)
+        if function is not None:
+            self._functions.move_to_end(key)
+            return function
+        function = employment_cost(compile_salary(params, consts), params)
+        self._functions[key] = function
+        if len(self._functions) > self.maxsize:
+            self._functions.popitem(last=False)
+        return function
+
+    def base_salary(self, budget, params, consts):
+        base_salary = self.function(params, consts).inverse(budget)
+        if base_salary < 0:
+            raise ValueError(f"employment_cost is above {budget} even with no salary")
+        return base_salary
+
+    def base_salary_batch(self, budgets, params, consts):
+        """Vectorized base_salary(), nan for budgets which cannot be met"""
+        base_salary = self.function(params, consts).inverse_batch(budgets)
+        return np.where(base_salary >= 0, base_salary, np.nan)
+
+
+class Params(TypedDict, total=False):
+    """The params of a profile, in the shape of default.cfg"""
+
+    TAX_YEAR: int
+    PENSION_EMPLOYEE: float
+    PENSION_EMPLOYER: float
+    PENSION_REPARATIONS: float
+    annual_numbers: bool
+    base_salary: float
+    percentage: float
+    travel_allowance: float
+    bonuses: float
+    ten_bis: float
+    goods: float
+    tax_pts: float
+    full_study_fund: bool
+    monthly_expense: float
+    current_cash: float
+    yearly_gain_rate: float
+    yearly_gain_stddev: float
+    target: Optional[float]
+    monthly_reparations_pull: Optional[float]
+    include_pension: bool
+    calculate_employment_cost: bool
+    tax_worth_expenses: float
+    independent_mode: bool
+    experimental_injected_previous_btl_worth: float
+    experimental_delay_natins_payment: bool
+    experimental_injected_previous_tax_worth: float
+    experimental_injected_45a_value: float
+    experimental_injected_net_income: float
+
+
+# Params a profile may omit (TOML has no None); experimental_* params are left
+# out when omitted, as in a .cfg
+PROFILE_DEFAULTS = {
+    "yearly_gain_stddev": 0,
+    "target": None,
+    "monthly_reparations_pull": None,
+}
+PROFILE_EXTENSIONS = (".toml", ".json")
+
+
+def _profile_types(hint):
+    """isinstance() types of the values accepted for a Params annotation"""
+    return tuple(
+        itertools.chain.from_iterable(
+            (int, float) if t is float else (t,) for t in get_args(hint) or (hint,)
+        )
+    )
+
+
+PROFILE_TYPES = {
+    key: _profile_types(hint) for key, hint in get_type_hints(Params).items()
+}
+PROFILE_REQUIRED = frozenset(
+    key
+    for key in PROFILE_TYPES
+    if key not in PROFILE_DEFAULTS and not key.startswith("experimental_")
+)
+
+
+def parse_profile(data, partial=False) -> Params:
+    """Validate a decoded TOML/JSON profile into params.
+
+    Raises ValueError on unknown params or values of the wrong type. Unless
+    partial (overrides on top of other params), missing params are filled from
+    PROFILE_DEFAULTS, or raise ValueError if required.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("expected a table of params")
+    for key, value in data.items():
+        accepted = PROFILE_TYPES.get(key)
+        if accepted is None:
+            raise ValueError(f"unknown param {key!r}")
+        if not isinstance(value, accepted) or (
+            isinstance(value, bool) and bool not in accepted
+        ):
+            names = " or ".join(
+                "None" if t is type(None) else t.__name__ for t in accepted
+            )
+            raise ValueError(f"{key} must be {names}, not {value!r}")
+    if partial:
+        return dict(data)
+    missing = PROFILE_REQUIRED.difference(data)
+    if missing:
+        raise ValueError(f"missing params {', '.join(sorted(missing))}")
+    return {**PROFILE_DEFAULTS, **data}
+
+
+def load_profile(path) -> Params:
+    """Load a declarative .toml or .json profile, without running any code"""
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML profiles require Python 3.11 or later")
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    return parse_profile(data)
+
+
+def load_config(path):
+    if path.endswith(PROFILE_EXTENSIONS):
+        return load_profile(path)
+    with open(path, "r", encoding="utf-8") as f:
+        params = {}
+        exec(f.read(), params)
+    return params
+
+
+def _toml_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return repr(value)
+
+
+def write_profile(params, path):
+    """Convert the params of a .cfg into a .toml or .json profile at path.
+
+    Params which profiles cannot express (e.g. a postprocess function) are
+    dropped with a warning. None values are omitted from TOML.
+    """
+    if not path.endswith(PROFILE_EXTENSIONS):
+        raise ValueError(f"profiles must end with {' or '.join(PROFILE_EXTENSIONS)}")
+    for key in params:
+        if key not in PROFILE_TYPES and not key.startswith("__"):
+            logging.getLogger().warning(
+                f"Dropping {key}, which profiles cannot express"
+            )
+    profile = parse_profile({k: v for k, v in params.items() if k in PROFILE_TYPES})
+    profile = {key: profile[key] for key in PROFILE_TYPES if key in profile}
+    with open(path, "w", encoding="utf-8") as f:
+        if path.endswith(".toml"):
+            f.writelines(
+                f"{key} = {_toml_value(value)}\n"
+                for key, value in profile.items()
+                if value is not None
+            )
+        else:
+            json.dump(profile, f, indent=4)
+            f.write("\n")
+
+
+STEPS_CONSTANTS = (
+    "INCOME_TAX_STEPS",
+    "NATIONAL_INSURANCE_STEPS",
+    "HEALTH_INSURANCE_STEPS",
+    "EMPLOYER_NATIONAL_INSURANCE_STEPS",
+    "INDEPENDENT_NATIONAL_INSURANCE_STEPS",
+)
+RATE_CONSTANTS = (
+    "PENSION_REIMBURSE",
+    "PENSION_INDEPENDENT_RATE_WRITEOFF",
+    "PENSION_INDEPENDENT_RATE_REIMBURSE",
+    "PENSION_INDEPENDENT_RATE_REIMBURSE_ACA",
+    "STUDY_FUND_EMPLOYEE",
+    "STUDY_FUND_EMPLOYER",
+    "STUDY_FUND_INDEPENDENT",
+)
+AMOUNT_CONSTANTS = (
+    "AVERAGE_SALARY",
+    "BASE_NUMBER_3",
+    "INCOME_TAX_POINT_WORTH",
+    "PENSION_REIMBURSE_PAYMENTS_MAX",
+    "PENSION_EMPLOYER_TAX_EXEMPT_PAYMENTS_MAX",
+    "PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX",
+    "REPARATIONS_PULL_TAX_EXEMPT_MAX",
+    "PENSION_INDEPENDENT_MAX_SALARY",
+    "STUDY_FUND_TAX_EXEMPT_MAX",
+    "STUDY_FUND_INDEPENDENT_MAX_SALARY",
+)
+CONSTANT_NAMES = STEPS_CONSTANTS + RATE_CONSTANTS + AMOUNT_CONSTANTS
+
+
+class Constants(Mapping):
+    """Validated, immutable constants of a tax year, see load_consts().
+
+    Constants are attributes, and can also be looked up by name like the dict
+    of a constants file. impl() and the other entry points to the stages also
+    accept such a dict, which they convert on every call; only Constants from
+    load_consts() are cached.
+    """
+
+    __slots__ = ("year", "digest", "_values", *CONSTANT_NAMES)
+
+    def __init__(self, year, digest, values):
+        object.__setattr__(self, "year", year)
+        object.__setattr__(self, "digest", digest)
+        constants = {}
+        for name in CONSTANT_NAMES:
+            value = values[name]
+            if name in STEPS_CONSTANTS and not isinstance(value, TaxSteps):
+                value = TaxSteps(value)
+            object.__setattr__(self, name, value)
+            constants[name] = value
+        object.__setattr__(self, "_values", types.MappingProxyType(constants))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("constants are immutable")
+
+    def __reduce__(self):
+        return Constants, (self.year, self.digest, dict(self))
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def validate_consts(year, consts):
+    """Raise ValueError if the constants of year are missing or out of range"""
+
+    def error(message):
+        return ValueError(f"constants for {year}: {message}")
+
+    for name in CONSTANT_NAMES:
+        if name not in consts:
+            raise error(f"{name} is missing")
+    for name in RATE_CONSTANTS + AMOUNT_CONSTANTS:
+        value = consts[name]
+        if not isinstance(value, (int, float)) or not 0 <= value < math.inf:
+            raise error(f"{name} is {value!r}")
+        if name in RATE_CONSTANTS and value > 1:
+            raise error(f"{name} is {value!r}, which is not a rate")
+    for name in STEPS_CONSTANTS:
+        steps = list(consts[name])
+        if not steps:
+            raise error(f"{name} is empty")
+        last_step = 0
+        for step, tax_rate in steps:
+            if not step > last_step:
+                raise error(f"{name} is not sorted")
+            if not 0 <= tax_rate < 1:
+                raise error(f"{name} has a rate of {tax_rate!r}")
+            last_step = step
+        if math.inf in (step for step, _ in steps[:-1]):
+            raise error(f"{name} has steps after math.inf")
+    if consts["INCOME_TAX_STEPS"][-1][0] != math.inf:
+        raise error("INCOME_TAX_STEPS does not end with a math.inf step")
+
+
+_consts_cache = {}
+
+
+CONSTANTS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "constants")
+
+
+def available_years():
+    return sorted(
+        int(name[:-3])
+        for name in os.listdir(CONSTANTS_DIR)
+        if name.endswith(".py") and name[:-3].isdigit()
+    )
+
+
+def load_consts(year):
+    """Load, validate and compile constants/<year>.py.
+
+    The result is cached by the file's content hash, so repeated loads (e.g. in
+    batch mode) only read the file.
+    """
+    with open(os.path.join(CONSTANTS_DIR, f"{year}.py"), "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    consts = _consts_cache.get(digest)
+    if consts is None:
+        values = {}
+        exec(source.decode("utf-8"), values)
+        validate_consts(year, values)
+        consts = _consts_cache[digest] = Constants(year, digest, values)
+    return consts
+
+
+# Every param impl() reads
+IMPL_PARAMS = (
+    "independent_mode",
+    "tax_worth_expenses",
+    "ten_bis",
+    "goods",
+    "tax_pts",
+    "full_study_fund",
+    "PENSION_EMPLOYEE",
+    "PENSION_EMPLOYER",
+    "PENSION_REPARATIONS",
+    "experimental_injected_previous_btl_worth",
+    "experimental_delay_natins_payment",
+    "experimental_injected_previous_tax_worth",
+    "experimental_injected_45a_value",
+    "experimental_injected_net_income",
+)
+
+
+class ImplCache:
+    """Bounded LRU cache of impl() results.
+
+    Results are keyed by the salaries, the IMPL_PARAMS values and the digest
+    of the constants, so only Constants from load_consts() are cached. Cached
+    results are shared and must not be modified.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def impl(self, social_salary, non_social_salary, params, consts) -> Result:
+        if not isinstance(consts, Constants):
+            return impl(social_salary, non_social_salary, params, consts)
+        key = (
+            social_salary,
+            non_social_salary,
+            consts.digest,
+            *(params.get(name) for name in IMPL_PARAMS),
+        )
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return result
+        result = impl(social_salary, non_social_salary, params, consts)
+        with self._lock:
+            self.misses += 1
+            self._results[key] = result
+            if len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return result
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._results),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def evaluate(params, consts, impl_cache: Optional[ImplCache] = None) -> Result:
+    """Run impl() and result_filter() on params, as in the paycheck details"""
+    social_salary, non_social_salary = salary_split(params)
+    run = impl if impl_cache is None else impl_cache.impl
+    return result_filter(params, run(social_salary, non_social_salary, params, consts))
+
+
+def batch_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in (".csv", ".jsonl"):
+        raise ValueError(f"unsupported batch file type {extension!r}")
+    return extension[1:]
+
+
+def read_batch(path):
+    """Stream the rows of a CSV file as dicts, or the lines of a JSONL file.
+
+    JSONL lines are decoded by batch_row_params(), so that a malformed line
+    only fails its own row.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if batch_format(path) == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield line
+
+
+def batch_columns(path, params):
+    """The columns run_batch() writes for a batch file in CSV.
+
+    These are the file's columns which are not params, base_salary with a
+    budget column, and then the Details fields. JSONL lines may each have
+    other keys, so all of them are read for the keys in order of appearance;
+    lines which are not objects are left to fail as rows.
+    """
+    if batch_format(path) == "csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            keys = next(csv.reader(f), [])
+    else:
+        keys = {}
+        for line in read_batch(path):
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(row, dict):
+                keys.update(dict.fromkeys(row))
+    columns = [key for key in keys if key not in params or key.startswith("__")]
+    if "budget" in columns:
+        columns.append("base_salary")
+    return columns + [field.name for field in fields(Details)]
+
+
+def parse_batch_value(value, default):
+    """Parse a CSV cell into the type of the config value it overrides"""
+    if value == "None":
+        return None
+    if isinstance(default, bool):
+        if value.lower() in ("true", "1"):
+            return True
+        if value.lower() in ("false", "0"):
+            return False
+        raise ValueError(f"invalid boolean {value!r}")
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def batch_row_params(params, row):
+    """Apply a batch row of overrides to params.
+
+    row is a dict of a CSV row or a JSONL line from read_batch(). Returns
+    (params, columns) where columns are the row's keys that are not params, as
+    is. Raises ValueError on a malformed line or overrides which are not valid
+    profile values.
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}") from None
+        if not isinstance(row, dict):
+            raise ValueError("expected an object of params")
+    overrides = {}
+    columns = {}
+    for key, value in row.items():
+        if key not in params or key.startswith("__"):
+            columns[key] = value
+        elif value == "":
+            # Empty cells keep the config value
+            continue
+        elif isinstance(value, str):
+            overrides[key] = parse_batch_value(value, params[key])
+        else:
+            overrides[key] = value
+    return dict(params, **parse_profile(overrides, partial=True)), columns
+
+
+def evaluate_batch(
+    params, rows, consts_by_year=None, impl_cache=None, budget_solver=None
+):
+    """Evaluate rows of param overrides on top of params.
+
+    Yields (columns, result) per row, where columns are the row's keys that are
+    not params (e.g. an employee id), passed through as is, and result is the
+    ValueError of rows which cannot be evaluated. Constants are loaded into
+    consts_by_year once per year. Rows with a budget get the maximal
+    base_salary for that employment cost, which is added to columns.
+    """
+    if consts_by_year is None:
+        consts_by_year = {}
+    if budget_solver is None:
+        budget_solver = BudgetSolver()
+    for row in rows:
+        columns = {}
+        try:
+            columns, row_params, consts = prepare_batch_row(
+                params, row, consts_by_year, budget_solver
+            )
+            result = evaluate(row_params, consts, impl_cache)
+        except ValueError as e:
+            result = e
+        yield columns, result
+
+
+def prepare_batch_row(params, row, consts_by_year, budget_solver):
+    """The (columns, params, consts) of a batch row, see evaluate_batch()"""
+    row_params, columns = batch_row_params(params, row)
+    year = row_params["TAX_YEAR"]
+    if year not in consts_by_year:
+        if year not in available_years():
+            raise ValueError(f"Tax calculations for {year} not supported")
+        consts_by_year[year] = load_consts(year)
+    row_params = params_filter(row_params)
+    if "budget" in columns:
+        scale = 12 if row_params["annual_numbers"] else 1
+        # Rows with no budget keep their base_salary
+        if columns["budget"] not in ("", None):
+            row_params["base_salary"] = budget_solver.base_salary(
+                float(columns["budget"]) / scale,
+                row_params,
+                consts_by_year[year],
+            )
+        columns["base_salary"] = round(row_params["base_salary"] * scale)
+    return columns, row_params, consts_by_year[year]
+
+
+# Params which salary_split() reads, besides the IMPL_PARAMS
+SALARY_PARAMS = ("base_salary", "percentage", "travel_allowance", "bonuses")
+
+
+def _vectorized_param(name, value):
+    # The experimental params are read as numbers by the stages
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and not name.startswith("experimental_")
+    )
+
+
+def _batch_group_key(params):
+    key = [params["TAX_YEAR"], params["annual_numbers"]]
+    for name in IMPL_PARAMS + SALARY_PARAMS:
+        value = params.get(name)
+        if not _vectorized_param(name, value):
+            key.append((name, value))
+    return tuple(key)
+
+
+def evaluate_batch_details(
+    params, rows, consts_by_year=None, budget_solver=None, chunk_size=1024
+):
+    """Vectorized evaluate_batch() of the Details alone.
+
+    Yields (columns, values) per row as evaluate_batch() does, where values are
+    the Details fields of result_filter(), in order. The rows of every chunk
+    which differ only in numeric params are evaluated at once by impl_batch()
+    and rounded in place by result_filter_batch(), so no Result or Details is
+    built per row.
+    """
+    require_numpy("batch evaluation")
+    if consts_by_year is None:
+        consts_by_year = {}
+    if budget_solver is None:
+        budget_solver = BudgetSolver()
+    rows = iter(rows)
+    for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+        results = []
+        groups = {}
+        for row in chunk:
+            try:
+                columns, row_params, consts = prepare_batch_row(
+                    params, row, consts_by_year, budget_solver
+                )
+            except ValueError as e:
+                results.append(({}, e))
+                continue
+            results.append(columns)
+            groups.setdefault(_batch_group_key(row_params), []).append(
+                (len(results) - 1, row_params, consts)
+            )
+        for group in groups.values():
+            _, group_params, consts = group[0]
+            group_params = dict(group_params)
+            for name in IMPL_PARAMS + SALARY_PARAMS:
+                if _vectorized_param(name, group_params.get(name)):
+                    group_params[name] = np.array(
+                        [row_params[name] for _, row_params, _ in group], dtype=float
+                    )
+            social_salary, non_social_salary = salary_split(group_params, BATCH_OPS)
+            result = result_filter_batch(
+                group_params,
+                impl_batch(social_salary, non_social_salary, group_params, consts),
+            )
+            size = len(group)
+            fields_values = [
+                (
+                    itertools.repeat(None, size)
+                    if value is None
+                    else np.broadcast_to(value, (size,)).astype(np.int64).tolist()
+                )
+                for value in _details_attributes(result.details)
+            ]
+            for (i, _, _), values in zip(group, zip(*fields_values)):
+                results[i] = (results[i], values)
+        yield from results
+
+
+def _init_batch_worker(params, impl_cache_size, details_only):
+    _worker_state["params"] = params
+    _worker_state["consts_by_year"] = {
+        params["TAX_YEAR"]: load_consts(params["TAX_YEAR"])
+    }
+    _worker_state["impl_cache"] = (
+        ImplCache(impl_cache_size) if impl_cache_size else None
+    )
+    _worker_state["budget_solver"] = BudgetSolver()
+    _worker_state["details_only"] = details_only
+
+
+def _evaluate_batch_chunk(rows):
+    if _worker_state["details_only"]:
+        return list(
+            evaluate_batch_details(
+                _worker_state["params"],
+                rows,
+                _worker_state["consts_by_year"],
+                _worker_state["budget_solver"],
+            )
+        )
+    return list(
+        evaluate_batch(
+            _worker_state["params"],
+            rows,
+            _worker_state["consts_by_year"],
+            _worker_state["impl_cache"],
+            _worker_state["budget_solver"],
+        )
+    )
+
+
+def evaluate_batch_parallel(
+    params, rows, jobs, chunk_size=256, impl_cache_size=0, details_only=False
+):
+    """evaluate_batch() over a pool of jobs processes, in the same order.
+
+    With impl_cache_size, every process keeps an ImplCache of that size. With
+    details_only, the processes run evaluate_batch_details() instead.
+    """
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    for results in parallel_map(
+        _evaluate_batch_chunk,
+        chunks,
+        jobs,
+        _init_batch_worker,
+        (picklable_params(params), impl_cache_size, details_only),
+    ):
+        yield from results
+
+
+def run_batch(params, path, output, output_format, jobs=1, impl_cache_size=0):
+    writer = None
+    rows = read_batch(path)
+    impl_cache = None
+    # CSV has no tax_values, so its rows need the Details alone, which are
+    # vectorized unless cached per row
+    details_only = output_format == "csv" and np is not None and not impl_cache_size
+    names = [field.name for field in fields(Details)]
+    if jobs != 1:
+        results = evaluate_batch_parallel(
+            params,
+            rows,
+            jobs,
+            impl_cache_size=impl_cache_size,
+            details_only=details_only,
+        )
+    elif details_only:
+        results = evaluate_batch_details(params, rows)
+    else:
+        if impl_cache_size:
+            impl_cache = ImplCache(impl_cache_size)
+        results = evaluate_batch(params, rows, impl_cache=impl_cache)
+    for number, (columns, result) in enumerate(results, 1):
+        if isinstance(result, ValueError):
+            logging.getLogger().error(f"Skipping batch row {number}: {result}")
+            continue
+        if details_only:
+            row = dict(columns, **dict(zip(names, result)))
+        else:
+            row = dict(columns, **asdict(result.details))
+        if output_format == "jsonl":
+            row["tax_values"] = result.tax_values
+            output.write(json.dumps(row) + "\n")
+        else:
+            if writer is None:
+                writer = csv.DictWriter(
+                    output,
+                    fieldnames=batch_columns(path, params),
+                    restval="",
+                    extrasaction="ignore",
+                )
+                writer.writeheader()
+            writer.writerow(row)
+    if impl_cache is not None:
+        logging.getLogger().debug(f"impl() cache: {impl_cache.info()}")
+
+
+# Params which select what is being calculated rather than being inputs to it
+GRID_EXCLUDED_PARAMS = ("TAX_YEAR", "annual_numbers", "independent_mode")
+
+
+def parse_grid_axis(spec, params):
+    """Parse a --grid axis, NAME=START:STOP:NUM or NAME=VALUE,VALUE,..."""
+    require_numpy("grid sweeps")
+    name, sep, values = spec.partition("=")
+    if not sep or name not in params or name in GRID_EXCLUDED_PARAMS:
+        raise ValueError(f"invalid grid axis {spec!r}")
+    if ":" in values:
+        start, stop, num = values.split(":")
+        values = np.linspace(float(start), float(stop), int(num))
+    else:
+        values = np.asarray([float(value) for value in values.split(",")])
+    if isinstance(params[name], bool):
+        values = values.astype(bool)
+    return name, values
+
+
+def grid_sweep(params, consts, axes, chunk_size=1 << 18):
+    """Evaluate impl_batch() over the cartesian grid of axes.
+
+    axes is a list of (param name, values) pairs, given in config units. The
+    grid is evaluated in blocks of rows along the first axis; yields (rows,
+    details) where rows is a slice and details maps every Details field to an
+    array of the block's shape. Fields which impl() leaves None, such as the
+    employer's pension in independent mode, are NaN.
+    """
+    require_numpy("grid sweeps")
+    names = [name for name, _ in axes]
+    if len(set(names)) != len(names):
+        raise ValueError("grid axes must be distinct params")
+    shape = tuple(len(values) for _, values in axes)
+    block_rows = max(1, chunk_size // math.prod(shape[1:]))
+    scale = 12 if params["annual_numbers"] else 1
+    for start in range(0, shape[0], block_rows):
+        rows = slice(start, min(start + block_rows, shape[0]))
+        grid_params = dict(params)
+        for i, (name, values) in enumerate(axes):
+            if i == 0:
+                values = values[rows]
+            grid_params[name] = values.reshape((-1,) + (1,) * (len(axes) - i - 1))
+        grid_params = params_filter(grid_params)
+        social_salary, non_social_salary = salary_split(grid_params, BATCH_OPS)
+        details = impl_batch(
+            social_salary, non_social_salary, grid_params, consts
+        ).details
+        block_shape = (rows.stop - rows.start,) + shape[1:]
+        yield rows, {
+            field.name: np.broadcast_to(
+                np.nan if value is None else value * scale, block_shape
+            )
+            for field, value in zip(fields(Details), _details_attributes(details))
+        }
+
+
+def run_grid(params, consts, axes, output):
+    """Write grid_sweep() as columns of float64 arrays.
+
+    output is either a .npz archive, or a directory with one .npy file per axis
+    and Details field, which np.load(..., mmap_mode="r") can map.
+    """
+    shape = tuple(len(values) for _, values in axes)
+    if output.endswith(".npz"):
+        columns = {field.name: np.empty(shape) for field in fields(Details)}
+    else:
+        os.makedirs(output, exist_ok=True)
+        for name, values in axes:
+            np.save(os.path.join(output, f"{name}.npy"), values)
+        columns = {
+            field.name: np.lib.format.open_memmap(
+                os.path.join(output, f"{field.name}.npy"),
+                mode="w+",
+                dtype=float,
+                shape=shape,
+            )
+            for field in fields(Details)
+        }
+    for rows, details in grid_sweep(params, consts, axes):
+        for name, values in details.items():
+            columns[name][rows] = values
+    if output.endswith(".npz"):
+        np.savez(output, **dict(axes), **columns)
+    else:
+        for column in columns.values():
+            column.flush()
+
+
+@dataclass
+class PayrollMonth:
+    month: int
+    result: Result
+    ytd_salary_for_income: float
+    ytd_in_tax: float
+
+
+class Payroll:
+    """Month by month payroll of a tax year, with cumulative income tax.
+
+    Every month is evaluated with impl() on its own params, so national
+    insurance uses that month's ceilings. Income tax is withheld by the
+    cumulative method: the tax of the year-to-date income over month times the
+    monthly brackets, less the year-to-date credits and the tax withheld so far.
+    Only these year-to-date totals are carried from month to month, along with
+    the tax each month would have withheld on its own, to reconcile against.
+    """
+
+    def __init__(self, consts):
+        self.consts = consts
+        self.months = 0
+        self.ytd_salary_for_income = 0
+        self.ytd_credits = 0
+        self.ytd_in_tax = 0
+        self.ytd_monthly_in_tax = 0
+
+    def _tax(self, months):
+        steps = self.consts["INCOME_TAX_STEPS"]
+        return max(
+            months * tax_steps(self.ytd_salary_for_income / months, steps)
+            - self.ytd_credits,
+            0,
+        )
+
+    def add_month(self, params) -> PayrollMonth:
+        """Run the next month's payroll.
+
+        The returned result is impl() of the month, with in_tax being the tax
+        withheld this month (negative for a refund) and netto_salary to match.
+        """
+        if self.months == 12:
+            raise ValueError("a tax year has 12 months")
+        social_salary, non_social_salary = salary_split(params)
+        result = impl(social_salary, non_social_salary, params, self.consts)
+        details = result.details
+        self.months += 1
+        self.ytd_salary_for_income += details.salary_for_income
+        # Tax points, pension reimbursements etc.
+        self.ytd_credits += (
+            tax_steps(details.salary_for_income, self.consts["INCOME_TAX_STEPS"])
+            - details.in_tax
+        )
+        in_tax = self._tax(self.months) - self.ytd_in_tax
+        self.ytd_in_tax += in_tax
+        self.ytd_monthly_in_tax += max(details.in_tax, 0)
+        details = replace(
+            details,
+            in_tax=in_tax,
+            netto_salary=details.netto_salary + max(details.in_tax, 0) - in_tax,
+        )
+        return PayrollMonth(
+            self.months,
+            Result(details, result.tax_values),
+            self.ytd_salary_for_income,
+            self.ytd_in_tax,
+        )
+
+    def reconcile(self, cumulative=True):
+        """Year-end reconciliation (tiyum mas): tax due for the whole year less
+        the tax withheld, negative for a refund.
+
+        Cumulative withholding settles the whole year by its 12th month, so this
+        is 0 for a full year and only matters for a partial one. With cumulative
+        False, the tax due is reconciled against every month withheld on its own
+        instead, as by an employer not withholding cumulatively.
+        """
+        withheld = self.ytd_in_tax if cumulative else self.ytd_monthly_in_tax
+        return self._tax(12) - withheld
+
+
+def run_payroll(params, consts, path):
+    """Print the payroll of a CSV/JSONL file with a row of overrides per month"""
+    payroll = Payroll(consts)
+    print("---Payroll---")
+    for row in read_batch(path):
+        month_params, _ = batch_row_params(params, row)
+        if month_params["TAX_YEAR"] != params["TAX_YEAR"]:
+            raise ValueError("all months must be of the same TAX_YEAR")
+        month = payroll.add_month(params_filter(month_params))
+        details = month.result.details
+        print(
+            f"Month {month.month}: salary {round(details.salary)}, income tax {round(details.in_tax)}, "
+            f"national insurance {round(details.natins_tax)}, health insurance {round(details.healthins_tax)}, "
+            f"net {round(details.netto_salary)} (year to date: income tax {round(month.ytd_in_tax)} "
+            f"from a salary of {round(month.ytd_salary_for_income)})"
+        )
+    if payroll.months < 12:
+        print_reconciliation("Year-end reconciliation", payroll.reconcile())
+    print_reconciliation(
+        "Without cumulative withholding", payroll.reconcile(cumulative=False)
+    )
+
+
+def print_reconciliation(title, reconciliation):
+    if reconciliation < 0:
+        print(f"{title}: refund of {round(-reconciliation)}")
+    else:
+        print(f"{title}: {round(reconciliation)} due")
+
+
+def _compare_year(item):
+    params, consts = item
+    social_salary, non_social_salary = salary_split(params)
+    result, rates = calculate_marginal_rates(
+        social_salary, non_social_salary, params, consts
+    )
+    return result_filter(params, result), rates
+
+
+def compare_years(params, years, jobs=1):
+    """Evaluate params against the constants of each of years.
+
+    All the constants are loaded up front, then the years are evaluated over
+    jobs processes. Returns (year, result_filter() result, RatesResult) tuples.
+    """
+    consts_by_year = {year: load_consts(year) for year in years}
+    params = picklable_params(params_filter(params))
+    items = [
+        (dict(params, TAX_YEAR=year), consts) for year, consts in consts_by_year.items()
+    ]
+    if jobs == 1:
+        results = map(_compare_year, items)
+    else:
+        results = parallel_map(_compare_year, items, jobs)
+    return [(year, *result) for year, result in zip(consts_by_year, results)]
+
+
+def print_year_comparison(comparison):
+    rows = [("", *(str(year) for year, _, _ in comparison))]
+    for field in fields(Details):
+        values = [getattr(result.details, field.name) for _, result, _ in comparison]
+        rows.append(
+            (field.name, *("-" if value is None else str(value) for value in values))
+        )
+    for field in fields(RatesResult):
+        values = [getattr(rates, field.name) for _, _, rates in comparison]
+        rows.append((field.name, *(f"{value:.2f}" for value in values)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print(
+            row[0].ljust(widths[0]),
+            *(value.rjust(width) for value, width in zip(row[1:], widths[1:])),
+        )
+
+
+def write_year_comparison(comparison, output, output_format):
+    writer = None
+    for year, result, rates in comparison:
+        row = dict(TAX_YEAR=year, **asdict(result.details), **asdict(rates))
+        if output_format == "jsonl":
+            row["tax_values"] = result.tax_values
+            output.write(json.dumps(row) + "\n")
+        else:
+            if writer is None:
+                writer = csv.DictWriter(output, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+
+
+def _best_time(function, repeat, min_time=0.05):
+    """Best time of a call to function over repeat runs, in seconds"""
+    number = 1
+    while True:
+        seconds = timeit.timeit(function, number=number)
+        if seconds >= min_time:
+            break
+        number *= 2
+    for _ in range(repeat - 1):
+        seconds = min(seconds, timeit.timeit(function, number=number))
+    return seconds / number
+
+
+def run_benchmarks(params, repeat=5, batch_size=2000, seed=0):
+    """Time the calculation hot paths on params, as a JSON-serializable report.
+
+    Inputs are generated from seed, so reports of different commits on the
+    same machine are comparable.
+    """
+    # e.g. negative income tax warnings would be repeated for every call
+    logging.disable(logging.WARNING)
+    try:
+        return _run_benchmarks(params, repeat, batch_size, seed)
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def _run_benchmarks(params, repeat, batch_size, seed):
+    params = params_filter(params)
+    results = []
+
+    def record(name, seconds, **info):
+        results.append(dict(name=name, **info, seconds=seconds))
+
+    # Single evaluation latency
+    for year in available_years():
+        consts = load_consts(year)
+        for independent_mode in (False, True):
+            year_params = dict(params, TAX_YEAR=year, independent_mode=independent_mode)
+            social_salary, non_social_salary = salary_split(year_params)
+            result = impl(social_salary, non_social_salary, year_params, consts)
+            mode = "independent" if independent_mode else "employee"
+            record(
+                "impl",
+                _best_time(
+                    lambda: impl(social_salary, non_social_salary, year_params, consts),
+                    repeat,
+                ),
+                year=year,
+                mode=mode,
+            )
+            record(
+                "result_filter",
+                _best_time(lambda: result_filter(year_params, result), repeat),
+                year=year,
+                mode=mode,
+            )
+
+    # Batch throughput
+    rng = random.Random(seed)
+    salaries = [rng.uniform(10000, 60000) for _ in range(batch_size)]
+    rows = [{"base_salary": salary} for salary in salaries]
+    seconds = _best_time(
+        lambda: collections.deque(evaluate_batch(params, rows), maxlen=0), repeat
+    )
+    record(
+        "evaluate_batch", seconds, rows=batch_size, rows_per_second=batch_size / seconds
+    )
+    consts = load_consts(params["TAX_YEAR"])
+    if np is not None:
+        salaries = np.asarray(salaries)
+        seconds = _best_time(lambda: impl_batch(salaries, 0, params, consts), repeat)
+        record(
+            "impl_batch", seconds, rows=batch_size, rows_per_second=batch_size / seconds
+        )
+
+    # End to end
+    if np is not None:
+        record(
+            "steps",
+            _best_time(lambda: scan_rate_segments_batch(params, consts), repeat),
+            mode="batch",
+        )
+    else:
+        record(
+            "steps",
+            _best_time(lambda: scan_rate_segments(params, consts), 1),
+            mode="scalar",
+        )
+    record(
+        "savings_months",
+        _best_time(lambda: savings_months(0, 5000, 1.05 ** (1 / 12), 10**6), repeat),
+    )
+    if np is not None:
+        record(
+            "simulate_savings_months",
+            _best_time(
+                lambda: simulate_savings_months(
+                    0, 5000, 1.05, 0.15, 10**6, 1000, 600, seed
+                ),
+                repeat,
+            ),
+            paths=1000,
+            months=600,
+        )
+
+    return {
+        "python": platform.python_version(),
+        "numpy": None if np is None else np.__version__,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def print_savings_simulation(params, monthly_gain, paths, horizon, seed=None):
+    months = simulate_savings_months(
+        params["current_cash"],
+        monthly_gain,
+        params["yearly_gain_rate"],
+        params.get("yearly_gain_stddev", 0),
+        params["target"],
+        paths,
+        round(horizon * 12),
+        seed,
+    )
+    print(f"---Savings simulation ({paths} paths)---")
+    percentiles = (5, 25, 50, 75, 95)
+    # inverted_cdf picks actual samples, so unreached (inf) paths stay inf
+    for percentile, value in zip(
+        percentiles,
+        np.percentile(months, percentiles, method="inverted_cdf"),
+    ):
+        years = "never" if value == np.inf else f"{value / 12:.1f} years"
+        print(f"{percentile}th percentile: {years}")
+    print(f"Reached within {horizon:g} years: {np.mean(months < np.inf) * 100:.1f}%")
+
+
+class CalculationServer(http.server.ThreadingHTTPServer):
+    """HTTP server answering POSTed params with their evaluate() result.
+
+    The request body is a JSON object of params in the shape of default.cfg,
+    checked against the profile schema and overriding the server's config. All
+    constants years are loaded up front, and the most recent distinct requests
+    are answered from a cache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, params, cache_size=4096, impl_cache_size=0):
+        super().__init__(address, CalculationHandler)
+        self.params = picklable_params(params)
+        self.consts_by_year = {year: load_consts(year) for year in available_years()}
+        self.calculate_json = functools.lru_cache(maxsize=cache_size)(
+            self._calculate_json
+        )
+        self.impl_cache = ImplCache(impl_cache_size) if impl_cache_size else None
+
+    def stats(self):
+        return {
+            "response_cache": self.calculate_json.cache_info()._asdict(),
+            "impl_cache": None if self.impl_cache is None else self.impl_cache.info(),
+        }
+
+    def calculate(self, payload):
+        if not isinstance(payload, dict):
+            raise ValueError("expected a JSON object of params")
+        return self.calculate_json(json.dumps(payload, sort_keys=True))
+
+    def _calculate_json(self, payload):
+        params = dict(self.params, **parse_profile(json.loads(payload), partial=True))
+        consts = self.consts_by_year.get(params["TAX_YEAR"])
+        if consts is None:
+            raise ValueError(f"Tax calculations for {params['TAX_YEAR']} not supported")
+        result = evaluate(params_filter(params), consts, self.impl_cache)
+        return json.dumps(
+            {"details": asdict(result.details), "tax_values": result.tax_values}
+        ).encode("utf-8")
+
+
+class CalculationHandler(http.server.BaseHTTPRequestHandler):
+    server: CalculationServer
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.respond(200, json.dumps(self.server.stats()).encode("utf-8"))
+        else:
+            self.respond(404, json.dumps({"error": "not found"}).encode("utf-8"))
+
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            response = self.server.calculate(json.loads(body or b"{}"))
+            status = 200
+        except (ValueError, KeyError, TypeError) as e:
+            response = json.dumps({"error": str(e)}).encode("utf-8")
+            status = 400
+        self.respond(status, response)
+
+    def respond(self, status, response):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.getLogger("server").debug(format, *args)
+
+
+def serve(params, address, impl_cache_size=0):
+    host, _, port = address.rpartition(":")
+    with CalculationServer(
+        (host or "127.0.0.1", int(port)), params, impl_cache_size=impl_cache_size
+    ) as server:
+        logging.getLogger().info(
+            f"Serving calculations on {server.server_address[0]}:{server.server_address[1]}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+# Functions timed by --profile, besides the impl() stages
+PROFILED_FUNCTIONS = (
+    "load_config",
+    "load_consts",
+    "impl",
+    "impl_batch",
+    "tax_steps",
+    "result_filter",
+    "savings_months",
+    "simulate_savings_months",
+)
+
+
+class Profiler:
+    """Call counts and wall time of this module's hot functions.
+
+    install() replaces the functions (and the impl() stages) in the module
+    with timing wrappers, and uninstall() puts them back, so nothing is paid
+    when not profiling. Times are inclusive, e.g. impl() includes its stages.
+    The stages look up brackets through their ImplOps rather than tax_steps(),
+    so these lookups are counted as tax_steps too, a whole batch counting once.
+    Worker processes are not profiled.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._originals = {}
+
+    def wrap(self, name, function):
+        stats = self.stats.setdefault(name, [0, 0.0])
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += time.perf_counter() - start
+
+        return wrapper
+
+    def install(self):
+        module = globals()
+        stages = {}
+        for name in ("EMPLOYEE_IMPL_STAGES", "INDEPENDENT_IMPL_STAGES"):
+            self._originals[name] = module[name]
+            module[name] = tuple(
+                stages.setdefault(stage, self.wrap(stage.__name__, stage))
+                for stage in module[name]
+            )
+        for name in PROFILED_FUNCTIONS:
+            self._originals[name] = module[name]
+            module[name] = self.wrap(name, module[name])
+        for name in ("SCALAR_OPS", "BATCH_OPS"):
+            ops = self._originals[name] = module[name]
+            module[name] = replace(ops, tax=self.wrap("tax_steps", ops.tax))
+
+    def uninstall(self):
+        globals().update(self._originals)
+        self._originals = {}
+
+    def report(self):
+        return {
+            name: {"calls": calls, "seconds": seconds}
+            for name, (calls, seconds) in self.stats.items()
+        }
+
+
+def main():
+    # Loading config
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "config", type=str, help="config to be used, a .cfg or a .toml/.json profile"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="extra logs")
+    parser.add_argument(
+        "-s", "--steps", action="store_true", help="print marginal tax rate steps"
+    )
+    parser.add_argument(
+        "-e",
+        "--exact",
+        action="store_true",
+        help="with --steps, derive the exact steps from the tax tables",
+    )
+    parser.add_argument(
+        "--steps-cache",
+        type=str,
+        default=STEPS_CACHE_DIR,
+        metavar="DIR",
+        help=f"directory caching the --steps segments (default: {STEPS_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--no-steps-cache",
+        dest="steps_cache",
+        action="store_const",
+        const=None,
+        help="always recompute the --steps segments",
+    )
+    parser.add_argument(
+        "-t",
+        "--net-table",
+        action="store_true",
+        help="print the net salary breakpoints by base salary",
+    )
+    parser.add_argument(
+        "--solve",
+        type=float,
+        metavar="TARGET",
+        help="find the base salary for which --solve-for reaches TARGET",
+    )
+    parser.add_argument(
+        "--solve-for",
+        choices=SOLVE_QUANTITIES,
+        default="netto_salary",
+        help="quantity to solve for (total_monthly_income is before postprocess)",
+    )
+    parser.add_argument(
+        "--optimize",
+        type=float,
+        metavar="BUDGET",
+        help="find the employee package which is best for an employment cost BUDGET",
+    )
+    parser.add_argument(
+        "--optimize-for",
+        choices=OPTIMIZE_OBJECTIVES,
+        default="total_monthly_income",
+        help="objective for --optimize (savings also counts pension and reparations)",
+    )
+    parser.add_argument(
+        "--monte-carlo",
+        type=int,
+        metavar="PATHS",
+        help="simulate time to savings target over PATHS random return paths",
+    )
+    parser.add_argument(
+        "--horizon",
+        type=float,
+        default=50,
+        help="years to simulate with --monte-carlo (default: 50)",
+    )
+    parser.add_argument("--seed", type=int, help="random seed for --monte-carlo")
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        help="evaluate every row of a CSV/JSONL file on top of the config",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="output file for --batch or --years (default: stdout), or --grid",
+    )
+    parser.add_argument(
+        "-g",
+        "--grid",
+        action="append",
+        metavar="NAME=RANGE",
+        help="sweep a param over START:STOP:NUM or comma separated values; "
+        "repeat for more axes. Writes the Details to --output, "
+        "a .npz file or a directory of .npy files",
+    )
+    parser.add_argument(
+        "--payroll",
+        type=str,
+        metavar="FILE",
+        help="run a monthly payroll with a row of overrides per month in a CSV/JSONL file",
+    )
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs="*",
+        metavar="YEAR",
+        help="compare the config across tax years (default: all available years)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="time the calculations on the config and print a JSON report (or to --output)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print call counts and time spent in the calculations to stderr, as JSON",
+    )
+    parser.add_argument(
+        "--convert",
+        type=str,
+        metavar="PROFILE",
+        help="convert the config into a declarative .toml or .json profile",
+    )
+    parser.add_argument(
+        "--serve",
+        type=str,
+        metavar="[HOST:]PORT",
+        help="serve calculations over HTTP, with the config as default params",
+    )
+    parser.add_argument(
+        "--impl-cache",
+        type=int,
+        default=0,
+        metavar="SIZE",
+        help="cache up to SIZE impl() results in --batch and --serve",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes for --batch, --steps and --years",
+    )
+    args = parser.parse_args()
+
+    if not args.profile:
+        run(args)
+        return
+    profiler = Profiler()
+    profiler.install()
+    try:
+        run(args)
+    finally:
+        profiler.uninstall()
+        print(json.dumps(profiler.report(), indent=2), file=sys.stderr)
+
+
+def run(args):
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    log = logging.getLogger()
+
+    try:
+        params = load_config(args.config)
+    except ValueError as e:
+        log.error(f"Cannot load {args.config}: {e}")
+        return
+
+    if args.convert:
+        try:
+            write_profile(params, args.convert)
+        except ValueError as e:
+            log.error(f"Cannot convert {args.config}: {e}")
+        return
+
+    if args.benchmark:
+        report = json.dumps(run_benchmarks(params), indent=2)
+        if args.output is None:
+            print(report)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(report + "\n")
+        return
+
+    if args.serve:
+        serve(params, args.serve, args.impl_cache)
+        return
+
+    if args.batch:
+        try:
+            output_format = batch_format(args.batch)
+            if args.output is not None:
+                output_format = batch_format(args.output)
+        except ValueError as e:
+            log.error(f"Cannot run batch: {e}")
+            return
+        if args.output is None:
+            run_batch(
+                params,
+                args.batch,
+                sys.stdout,
+                output_format,
+                args.jobs,
+                args.impl_cache,
+            )
+        else:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                run_batch(
+                    params, args.batch, f, output_format, args.jobs, args.impl_cache
+                )
+        return
+
+    if args.years is not None:
+        years = args.years or available_years()
+        for year in years:
+            if year not in available_years():
+                log.error(f"Tax calculations for {year} not supported")
+                return
+        if args.output is not None:
+            try:
+                output_format = batch_format(args.output)
+            except ValueError as e:
+                log.error(f"Cannot compare years: {e}")
+                return
+        try:
+            comparison = compare_years(params, years, args.jobs)
+        except ValueError as e:
+            log.error(f"Invalid {e}")
+            return
+        if args.output is None:
+            print("---Year comparison---")
+            print_year_comparison(comparison)
+        else:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                write_year_comparison(comparison, f, output_format)
+        return
+
+    try:
+        consts = load_consts(params["TAX_YEAR"])
+    except FileNotFoundError:
+        log.error(f"Tax calculations for {params['TAX_YEAR']} not supported")
+        return
+    except ValueError as e:
+        log.error(f"Invalid {e}")
+        return
+
+    if args.monte_carlo and params["target"] is None:
+        log.error("--monte-carlo requires a target")
+        return
+    if args.monte_carlo and np is None:
+        log.error("--monte-carlo requires numpy to be installed")
+        return
+
+    if args.grid:
+        if args.output is None:
+            log.error("--grid requires --output")
+            return
+        if np is None:
+            log.error("--grid requires numpy to be installed")
+            return
+        try:
+            axes = [parse_grid_axis(spec, params) for spec in args.grid]
+            run_grid(params, consts, axes, args.output)
+        except ValueError as e:
+            log.error(f"Cannot sweep grid: {e}")
+        return
+
+    if args.payroll:
+        try:
+            run_payroll(params, consts, args.payroll)
+        except ValueError as e:
+            log.error(f"Cannot run payroll: {e}")
+        return
+
+    params = params_filter(params)
+
+    if args.steps:
+        print("---Tax steps analysis---")
+        if args.steps_cache is None or args.verbose:
+            segments = rate_segments(
+                params, consts, args.exact, args.verbose, args.jobs
+            )
+        else:
+            segments = cached_rate_segments(
+                args.steps_cache, params, consts, args.exact, args.jobs
+            )
+        print_rate_segments(params, segments)
+        return
+
+    if args.solve is not None:
+        scale = 12 if params["annual_numbers"] else 1
+        try:
+            base_salary = solve_base_salary(
+                args.solve / scale, params, consts, args.solve_for
+            )
+        except ValueError as e:
+            log.error(f"Cannot solve for base salary: {e}")
+            return
+        params = dict(params, base_salary=base_salary)
+        print(f"Base salary: {round(base_salary * scale)}")
+
+    if args.optimize is not None:
+        scale = 12 if params["annual_numbers"] else 1
+        try:
+            params, _ = optimize_compensation(
+                args.optimize / scale, params, consts, args.optimize_for
+            )
+        except ValueError as e:
+            log.error(f"Cannot optimize compensation: {e}")
+            return
+        print(
+            f"Base salary: {round(params['base_salary'] * scale)}, bonuses: {round(params['bonuses'] * scale)}, "
+            f"employee pension: {params['PENSION_EMPLOYEE']:.0%}, full study fund: {params['full_study_fund']}"
+        )
+
+    if args.net_table:
+        print("---Net salary table---")
+        print_net_table(params, consts)
+        return
+
+    social_salary, non_social_salary = salary_split(params)
+    result, effrate = calculate_marginal_rates(
+        social_salary, non_social_salary, params, consts
+    )
+
+    rate = [
+        rate
+        for ceiling, rate in consts["INCOME_TAX_STEPS"]
+        if result.details.salary_for_income < ceiling
+    ][0]
+    effrate_text = (
+        f"; effective marginal rate {effrate.income_rate:.2f}"
+        if abs(rate - effrate.income_rate) >= 0.01
+        else ""
+    )
+
+    result_pretty = result_filter(params, result)
+    log_tax = logging.getLogger("taxes")
     for k, v in result_pretty.tax_values.items():
         log_tax.debug(f"{k}={v}")
     details_pretty = result_pretty.details
@@ -432,45 +3550,11 @@ def main():
 
     # Part 2 (total income)
     details = result.details
-    if details.reparations is None:
-        reparations_cash = 0
-    else:
-        reparations_cash = min(
-            details.reparations, consts["REPARATIONS_PULL_TAX_EXEMPT_MAX"]
-        )
-        if details.reparations > consts["PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX"]:
-            reparations_cash += (
-                details.reparations
-                - consts["PENSION_REPARATIONS_TAX_EXEMPT_PAYMENTS_MAX"]
-            )
-        if params["include_pension"]:
-            reparations_cash = details.reparations
-        elif (
-            params["monthly_reparations_pull"]
-            and details.reparations > consts["REPARATIONS_PULL_TAX_EXEMPT_MAX"]
-        ):
-            taxed_reparations = details.reparations - reparations_cash
-            tax_rate = (
-                income_tax(
-                    params["monthly_reparations_pull"], params["tax_pts"], consts
-                )
-                / params["monthly_reparations_pull"]
-            )
-            reparations_cash += taxed_reparations * (1 - tax_rate)
-
-    sfund_cash = (
-        details.sfund
-        if details.sfund_employer is None
-        else details.sfund + details.sfund_employer
-    )
-    pens_total = (
-        details.pens
-        if details.pens_employer is None
-        else (details.pens + details.pens_employer)
-    )
-    total_monthly_income = details.netto_salary + reparations_cash + sfund_cash
-    if params["include_pension"]:
-        total_monthly_income += pens_total
+    income = calculate_income(details, params, consts)
+    reparations_cash = income.reparations_cash
+    sfund_cash = income.sfund_cash
+    pens_total = income.pens_total
+    total_monthly_income = income.total_monthly_income
     total_monthly_income2 = params.get("postprocess", lambda x: x)(total_monthly_income)
 
     if params["annual_numbers"]:
@@ -492,31 +3576,26 @@ def main():
     if params["target"] is not None:
         monthly_gain = total_monthly_income - params["monthly_expense"]
         monthly_gain_rate = params["yearly_gain_rate"] ** (1 / 12)
-        years = 0
-        for i in itertools.count():
-            if (
-                params["current_cash"] * monthly_gain_rate**i
-                + sum(monthly_gain * monthly_gain_rate**j for j in range(i))
-                >= params["target"]
-            ):
-                years = i / 12
-                break
-        print(
-            f"{years:.1f} years to reach target of {round(params['target'])} with {round(monthly_gain)} monthly saving"
+        months = savings_months(
+            params["current_cash"], monthly_gain, monthly_gain_rate, params["target"]
         )
+        if months is None:
+            print(
+                f"Target of {round(params['target'])} is unreachable with {round(monthly_gain)} monthly saving"
+            )
+        else:
+            years = months / 12
+            print(
+                f"{years:.1f} years to reach target of {round(params['target'])} with {round(monthly_gain)} monthly saving"
+            )
+        if args.monte_carlo:
+            print_savings_simulation(
+                params, monthly_gain, args.monte_carlo, args.horizon, args.seed
+            )
 
     # Part 4 (employment cost)
     if not params["independent_mode"] and params["calculate_employment_cost"]:
-        employment_cost = (
-            details.salary
-            + params["ten_bis"]
-            + params["goods"]
-            + details.natins_employer
-            + details.pens_employer
-            + details.reparations
-            + details.sfund_employer
-        )
-        print(f"Employment cost: {round(employment_cost)}")
+        print(f"Employment cost: {round(employment_cost(details, params))}")
 
 
 if __name__ == "__main__":